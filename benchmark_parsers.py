@@ -0,0 +1,143 @@
+"""Микробенчмарк парсеров ответов Gemini с вопросами теста.
+
+Корпус - типичные ответы модели (основной формат, нумерованный английский,
+markdown, JSON) и испорченные выводы, на которых регулярные выражения
+склонны к перебору с возвратами. Для каждого испорченного вывода время
+замеряется на длинах n и SCALE * n: у линейного парсера отношение времён
+близко к SCALE, у квадратичного - к SCALE ** 2.
+
+Парсеры - методы класса GrammarTest, поэтому бенчмарк не создаёт тест
+(и не открывает базу, не настраивает Gemini).
+
+Запуск: python benchmark_parsers.py
+"""
+import json
+import sys
+import time
+
+from grammar_test import GrammarTest, QuestionStreamParser
+
+# Во сколько раз увеличиваем испорченные выводы при проверке линейности
+SCALE = 4
+# Отношение времён, выше которого fallback_parse считается нелинейным
+MAX_RATIO = SCALE * 2.5
+# Сколько раз повторяем замер (берём лучшее время - оно меньше всего зависит от шума)
+REPEATS = 5
+
+
+def standard_output(count=10):
+    """Ответ в основном формате промпта: ВОПРОС N / варианты / СЛОЖНОСТЬ / ОТВЕТ / ОБЪЯСНЕНИЕ"""
+    blocks = []
+    for i in range(1, count + 1):
+        blocks.append(
+            f"ВОПРОС {i}:\n"
+            f"She ___ to school every day ({i}).\n"
+            "a) go\nb) goes\nc) going\nd) gone\n"
+            "СЛОЖНОСТЬ: easy\n"
+            "ОТВЕТ: b\n"
+            "ОБЪЯСНЕНИЕ: Present Simple, третье лицо единственного числа.\n"
+        )
+    return "\n".join(blocks)
+
+
+def numbered_output(count=10):
+    """Ответ не по формату: нумерация, английские метки и markdown - его разбирает fallback_parse"""
+    blocks = ["Here is your test on English tenses:\n"]
+    for i in range(1, count + 1):
+        blocks.append(
+            f"{i}. Choose the correct answer: they ___ here since 20{i:02d}.\n"
+            "A) live\nB) lived\nC) have lived\nD) are living\n"
+            "**Correct answer:** C\n"
+            "**Explanation:** Present Perfect with since.\n"
+        )
+    return "\n".join(blocks)
+
+
+def json_output(count=10):
+    """Ответ в структурированном режиме (QUESTIONS_SCHEMA)"""
+    questions = [
+        {
+            "question": f"I ___ him yesterday ({i}).",
+            "options": {"a": "see", "b": "saw", "c": "seen", "d": "seeing"},
+            "correct_answer": "b",
+            "explanation": "Past Simple.",
+            "difficulty": "medium"
+        }
+        for i in range(count)
+    ]
+    return json.dumps({"questions": questions}, ensure_ascii=False)
+
+
+# Испорченные выводы: функция длины n -> текст
+ADVERSARIAL = {
+    'одна длинная строка': lambda n: 'x' * n,
+    'только варианты a)': lambda n: 'Question?\n' + 'a) option\n' * (n // 10),
+    'варианты без ответа': lambda n: 'Q?\na) 1\nb) 2\nc) 3\nd) 4\n' * (n // 24),
+    'поток меток ОТВЕТ': lambda n: 'Q?\na) 1\nb) 2\nc) 3\nd) 4\n' + 'ОТВЕТ ' * (n // 6),
+    'знаки препинания': lambda n: 'Q?\na) 1\nb) 2\nc) 3\nd) 4\n' + '*' * (n // 2) + 'answer' + ':' * (n // 2),
+    'пробелы после заголовка': lambda n: 'ВОПРОС' + ' ' * (n // 2) + '\na)' + ' ' * (n // 2),
+    'оборванный ответ': lambda n: (standard_output(n // 300 + 1))[:n],
+}
+
+
+def measure(parse, text):
+    """Лучшее из REPEATS времён разбора text в миллисекундах"""
+    timings = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        parse(text)
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+def stream_parse(text):
+    """Разбор потоком: ответ приходит фрагментами по 64 символа"""
+    parser = QuestionStreamParser(GrammarTest.parse_question_block)
+    questions = []
+    for start in range(0, len(text), 64):
+        questions.extend(parser.feed(text[start:start + 64]))
+    questions.extend(parser.finish())
+    return questions
+
+
+def growth_ratio(parse, make, size):
+    """Время разбора на (тексте длины size, тексте длины SCALE * size, их отношение)"""
+    small_time, large_time = measure(parse, make(size)), measure(parse, make(size * SCALE))
+    return small_time, large_time, large_time / max(small_time, 0.01)
+
+
+def main():
+    parsers = {
+        'parse_test_response': GrammarTest.parse_test_response,
+        'fallback_parse': GrammarTest.fallback_parse,
+        'decode_questions_json': GrammarTest.decode_questions_json,
+        'QuestionStreamParser': stream_parse,
+    }
+    
+    print("Типичные ответы (мс, найдено вопросов):")
+    for name, text in (('основной', standard_output()), ('нумерованный', numbered_output()), ('JSON', json_output())):
+        results = ", ".join(
+            f"{parser_name} {measure(parse, text):.2f} ({len(parse(text) or [])})"
+            for parser_name, parse in parsers.items()
+        )
+        print(f"• {name} ({len(text)} символов): {results}")
+    
+    size = 50000
+    failures = []
+    print(f"\nИспорченные выводы: время на {size} и {size * SCALE} символов (линейно - отношение около {SCALE}):")
+    for case, make in ADVERSARIAL.items():
+        print(f"• {case}:")
+        for parser_name in ('parse_test_response', 'fallback_parse'):
+            small_time, large_time, ratio = growth_ratio(parsers[parser_name], make, size)
+            print(f"    {parser_name}: {small_time:.2f} -> {large_time:.2f} мс (x{ratio:.1f})")
+            if parser_name == 'fallback_parse' and ratio > MAX_RATIO and large_time > 1:
+                failures.append(case)
+    
+    if failures:
+        print(f"\nfallback_parse растёт нелинейно: {', '.join(failures)}")
+        sys.exit(1)
+    print("\nfallback_parse линеен на всём корпусе")
+
+
+if __name__ == '__main__':
+    main()
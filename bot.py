@@ -1,5 +1,8 @@
+import asyncio
 import logging
+from collections import deque
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -9,11 +12,21 @@ from telegram.ext import (
     filters,
     ConversationHandler
 )
-from config import TELEGRAM_BOT_TOKEN
-from database import Database
+from config import (
+    TELEGRAM_BOT_TOKEN, ADMIN_USER_IDS, BOT_MODE, CONCURRENT_UPDATES,
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_URL_PATH, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN,
+    HEALTH_LISTEN, HEALTH_PORT, DIALOGUE_EDIT_INTERVAL
+)
+from database import AsyncDatabase
 from grammar_test import GrammarTest
+from grammar_test_pool import GrammarTestPool
+from gemini_service import GeminiService
 from dialogue import Dialogue
 from vocabulary import Vocabulary
+from review import Review
+from session_store import ConversationStates, session_store
+from health import HealthServer
+from parse_stats import parse_stats
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,6 +35,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Количество тем на странице списка изученных слов
+HISTORY_PAGE_SIZE = 10
+
 # Состояния для ConversationHandler
 (
     WAITING_FOR_TEST_ANSWER,
@@ -47,6 +63,11 @@ help_text = """
 */vocabulary* - Изучить новые слова по конкретной теме
   Укажите тему, и бот сгенерирует список слов с примерами
   
+*/review* - Повторить изученные слова (интервальное повторение)
+  Бот показывает слова, которые пора повторить, и планирует следующее повторение
+  
+*/find <запрос>* - Найти среди изученных слов (по слову, переводу или примеру)
+  
 */history* - Посмотреть историю ваших тестов и изученных слов
 
 */cancel* - Отменить текущее действие
@@ -54,18 +75,46 @@ help_text = """
 Удачи в изучении английского! 🚀
 """
 
+async def save_abandoned_test(user_id, test):
+    """Сохранить промежуточный результат брошенного теста (вызывается при вытеснении)"""
+    test.cancel_generation()
+    if test.user_answers:
+        test_results = test.get_results()
+        await db.save_test_result(user_id, test_results, test_results['score'])
+
+
 # Глобальные объекты
-db = Database()
-grammar_tests = {}  # Храним тесты для каждого пользователя
+db = AsyncDatabase()
+grammar_tests = session_store.namespace(  # Храним тесты для каждого пользователя
+    'grammar_tests',
+    on_evict=save_abandoned_test,
+    dump=GrammarTest.to_state,
+    load=GrammarTest.from_state
+)
+test_pool = GrammarTestPool()  # Пул заранее сгенерированных тестов
 dialogues = Dialogue()
 vocabulary_service = Vocabulary()
-dialogue_states = {}  # Храним состояние диалогов (ключ для ConversationHandler)
+review_service = Review()
+dialogue_states = session_store.namespace(  # Храним состояние диалогов (ключ для ConversationHandler)
+    'dialogue_states',
+    dump=int,
+    load=int
+)
+health_server = HealthServer(  # Проверка работоспособности для балансировщика
+    HEALTH_LISTEN,
+    HEALTH_PORT,
+    get_status=lambda: {
+        'mode': BOT_MODE,
+        'pending_writes': db.write_queue.get_stats()['pending'],
+        'gemini': GeminiService.get_circuit_breaker().state
+    }
+)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
-    db.add_user(user.id, user.username, user.first_name)
+    await db.add_user(user.id, user.username, user.first_name)
     
     welcome_text = f"""
 👋 Привет, {user.first_name}!
@@ -76,6 +125,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📝 /test - Создать тест по временам английского языка
 💬 /dialogue - Начать диалог (покупатель-продавец)
 📚 /vocabulary - Изучить новые слова по теме
+🔁 /review - Повторить изученные слова
 📊 /history - Посмотреть историю тестов и изученных слов
 ℹ️ /help - Помощь по командам
 
@@ -91,7 +141,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardButton("📚 Изучить слова", callback_data="menu_vocabulary"),
             InlineKeyboardButton("📊 История", callback_data="menu_history")
         ],
-        [InlineKeyboardButton("ℹ️ Помощь", callback_data="menu_help")]
+        [
+            InlineKeyboardButton("🔁 Повторение", callback_data="menu_review"),
+            InlineKeyboardButton("ℹ️ Помощь", callback_data="menu_help")
+        ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -138,6 +191,19 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == "menu_history":
         await show_history(query.from_user.id, query, is_callback=True)
 
+    elif data == "menu_review":
+        await start_review(query.from_user.id, query.message)
+
+    elif data == "review_show":
+        await show_review_answer(query)
+
+    elif data.startswith("review_grade_"):
+        grade, _, number = data.replace("review_grade_", "").partition("_")
+        await grade_review_card(query, int(grade), int(number) if number else None)
+
+    elif data.startswith("vocab_page"):
+        await show_vocabulary_page(query, data.partition(":")[2])
+
     elif data == "menu_help":
         keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="menu_back")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -154,6 +220,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         tense = data.replace("tense_", "")
         await start_test_callback(query, context, tense)
 
+    elif data.startswith("bank_"):
+        tense = data.replace("bank_", "")
+        await start_test_callback(query, context, tense, from_bank=True)
+
     elif data.startswith("role_"):
         # Роль пользователя
         user_role = "seller" if "seller" in data else "buyer"
@@ -171,7 +241,10 @@ def get_main_keyboard():
             InlineKeyboardButton("📚 Изучить слова", callback_data="menu_vocabulary"),
             InlineKeyboardButton("📊 История", callback_data="menu_history")
         ],
-        [InlineKeyboardButton("ℹ️ Помощь", callback_data="menu_help")]
+        [
+            InlineKeyboardButton("🔁 Повторение", callback_data="menu_review"),
+            InlineKeyboardButton("ℹ️ Помощь", callback_data="menu_help")
+        ]
     ]
     return InlineKeyboardMarkup(keyboard)
 
@@ -187,6 +260,7 @@ def get_tense_keyboard():
             InlineKeyboardButton("Past", callback_data="tense_past"),
             InlineKeyboardButton("Future", callback_data="tense_future")
         ],
+        [InlineKeyboardButton("⚡ Из банка вопросов (новые для вас)", callback_data="bank_all")],
         [InlineKeyboardButton("◀️ Назад", callback_data="menu_back")]
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -204,20 +278,51 @@ def get_role_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
-async def start_test_callback(query, context: ContextTypes.DEFAULT_TYPE, tense_type):
+async def start_test_callback(query, context: ContextTypes.DEFAULT_TYPE, tense_type, from_bank=False):
     """Начать тест по грамматике через callback"""
     user_id = query.from_user.id
     
-    await query.message.reply_text("⏳ Создаю тест... Это может занять несколько секунд.")
-    
-    # Создаем тест
     test = GrammarTest()
-    success, message = test.create_test(tense_type)
+    success = False
+    
+    # Тест из банка вопросов собирается без обращения к Gemini
+    if from_bank:
+        success, message = await test.create_test_from_bank(user_id, tense_type)
+        if not success:
+            await query.message.reply_text(f"ℹ️ {message}, создаю обычный тест.")
+    
+    if not success:
+        # Пробуем взять готовый тест из пула, иначе генерируем новый
+        questions = await test_pool.get_test(tense_type)
+        if questions:
+            success, message = test.load_test(questions, tense_type)
+        elif GeminiService.is_available():
+            await query.message.reply_text("⏳ Создаю тест... Это может занять несколько секунд.")
+            if session_store.backend is None and not GeminiService.structured_output:
+                # Тест начинается, как только готовы первые вопросы, остальные догенерируются, пока пользователь отвечает
+                success, message = await test.create_test_streaming(user_id, tense_type)
+            else:
+                # Общее хранилище сохраняет тест после обработки обновления - догенерация в фоне туда не попадёт.
+                # JSON по схеме (GEMINI_STRUCTURED_OUTPUT) разбирается только целиком, поэтому тоже без потока
+                success, message = await test.create_test(tense_type)
+    
+    if not success and not from_bank:
+        # Gemini недоступен или не справился - собираем тест из банка уже сгенерированных вопросов
+        success, _ = await test.create_test_from_bank(user_id, tense_type)
+        if success:
+            await query.message.reply_text("ℹ️ Сервис генерации сейчас недоступен, тест собран из банка вопросов.")
+        else:
+            message = message if GeminiService.is_available() else "Сервис генерации временно недоступен, попробуйте позже"
     
     if not success:
         await query.message.reply_text(f"❌ Ошибка: {message}")
         return
     
+    await test.mark_questions_seen(user_id)
+    previous_test = grammar_tests.get(user_id)
+    if previous_test is not None:
+        # Новый тест заменяет старый - его догенерация больше не нужна
+        previous_test.cancel_generation()
     grammar_tests[user_id] = test
     dialogue_states[user_id] = WAITING_FOR_TEST_ANSWER
     
@@ -270,7 +375,9 @@ async def handle_test_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
         response_text = f"{correctness}\n\n"
         response_text += f"💡 Объяснение: {result['explanation']}\n\n"
         
-        # Получаем следующий вопрос
+        # Получаем следующий вопрос (при потоковом создании он может ещё генерироваться)
+        if test.is_generating():
+            await test.wait_for_question()
         next_question = test.get_current_question()
         if next_question:
             response_text += test.format_question_text(next_question)
@@ -284,7 +391,7 @@ async def handle_test_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
             response_text += f"Оценка: {test_results['score']}%"
             
             # Сохраняем результат
-            db.save_test_result(user_id, test_results, test_results['score'])
+            await db.save_test_result(user_id, test_results, test_results['score'])
             
             await update.message.reply_text(response_text)
             del grammar_tests[user_id]
@@ -338,12 +445,15 @@ async def dialogue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 def format_grammar_feedback(grammar_check):
     """Форматировать обратную связь по грамматике"""
+    if grammar_check.get('unavailable'):
+        return "⚠️ *Грамматика:* Проверка сейчас недоступна, попробуйте позже."
+    
     if grammar_check['errors_count'] == 0:
         return "✅ *Грамматика:* Отлично! Ошибок нет."
     
     text = f"📝 *Проверка грамматики:* Найдено ошибок: {grammar_check['errors_count']}\n"
     
-    if grammar_check['corrected_text'] != grammar_check.get('original', ''):
+    if grammar_check['corrected_text'] and grammar_check['corrected_text'] != grammar_check.get('original', ''):
         text += f"✏️ *Исправленный вариант:* _{grammar_check['corrected_text']}_\n"
     
     if grammar_check['mistakes']:
@@ -354,6 +464,20 @@ def format_grammar_feedback(grammar_check):
     return text
 
 
+def format_dialogue_reply(result, ai_role_text, partial=False):
+    """Форматировать сообщение с проверкой грамматики и репликой собеседника"""
+    if result['grammar_check'] is None:
+        response_text = "⏳ Проверяю грамматику...\n\n"
+    else:
+        response_text = format_grammar_feedback(result['grammar_check']) + "\n\n"
+    
+    response_text += f"📊 Обмен {result['current_exchange']}/{result['max_exchanges']}\n\n"
+    response_text += f"🤖 *{ai_role_text}:*\n{result['response']}"
+    if partial:
+        response_text += " ✍️"
+    return response_text
+
+
 def format_dialogue_statistics(stats):
     """Форматировать статистику диалога"""
     if not stats:
@@ -385,6 +509,45 @@ def format_dialogue_statistics(stats):
     return text
 
 
+async def deliver_dialogue_reply(placeholder, message, text, partial, attempts=3):
+    """Показать реплику в сообщении-заглушке; вернуть True, если текст доставлен.
+    
+    Промежуточную правку при любой ошибке пропускаем - следующий фрагмент её заменит.
+    Итоговую повторяем: после RetryAfter ждём указанное время, при BadRequest
+    (незакрытая разметка) отправляем без Markdown, а если правка так и не удалась,
+    присылаем реплику новым сообщением.
+    """
+    parse_mode = 'Markdown'
+    for _ in range(attempts):
+        try:
+            await placeholder.edit_text(text, parse_mode=parse_mode)
+            return True
+        except RetryAfter as e:
+            if partial:
+                return False
+            await asyncio.sleep(e.retry_after)
+        except BadRequest as e:
+            # Незакрытая разметка (часто в недописанной реплике)
+            if partial:
+                return False
+            if parse_mode is None:
+                logger.warning("Не удалось обновить сообщение диалога: %s", e)
+                break
+            parse_mode = None
+        except TelegramError as e:
+            logger.warning("Не удалось обновить сообщение диалога: %s", e)
+            break
+    
+    if partial:
+        return False
+    try:
+        await message.reply_text(text)
+        return True
+    except TelegramError as e:
+        logger.error("Не удалось отправить реплику диалога: %s", e)
+        return False
+
+
 async def handle_dialogue_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработать сообщение в диалоге"""
     user_id = update.effective_user.id
@@ -399,23 +562,32 @@ async def handle_dialogue_message(update: Update, context: ContextTypes.DEFAULT_
     ai_role = dialogues.get_ai_role(user_id)
     ai_role_text = "Покупатель" if ai_role == "buyer" else "Продавец"
     
-    # Отправляем сообщение и получаем результат
-    result = dialogues.send_message(user_id, user_message)
-    
-    # Формируем ответ
-    response_text = ""
-    
-    # 1. Проверка грамматики
-    grammar_feedback = format_grammar_feedback(result['grammar_check'])
-    response_text += grammar_feedback + "\n\n"
-    
-    # 2. Прогресс диалога
-    response_text += f"📊 Обмен {result['current_exchange']}/{result['max_exchanges']}\n\n"
-    
-    # 3. Ответ ИИ
-    response_text += f"🤖 *{ai_role_text}:*\n{result['response']}"
+    # Сразу показываем заглушку и дописываем её по мере генерации реплики
+    placeholder = await update.message.reply_text(f"🤖 {ai_role_text} печатает...")
+    last_edit = {'at': 0.0, 'text': None}
+    # Реплика и проверка грамматики сообщают о прогрессе параллельно - правки идут по очереди
+    edit_lock = asyncio.Lock()
+    
+    async def show(result, partial):
+        async with edit_lock:
+            response_text = format_dialogue_reply(result, ai_role_text, partial)
+            if response_text == last_edit['text']:
+                return
+            delivered = await deliver_dialogue_reply(placeholder, update.message, response_text, partial)
+            last_edit['at'] = asyncio.get_running_loop().time()
+            if delivered:
+                last_edit['text'] = response_text
+    
+    async def on_progress(result):
+        # Не чаще раза в DIALOGUE_EDIT_INTERVAL: Telegram ограничивает частоту правок.
+        # Пока идёт другая правка, промежуточную пропускаем - следующий фрагмент её заменит
+        if edit_lock.locked():
+            return
+        if asyncio.get_running_loop().time() - last_edit['at'] >= DIALOGUE_EDIT_INTERVAL:
+            await show(result, partial=True)
     
-    await update.message.reply_text(response_text, parse_mode='Markdown')
+    result = await dialogues.send_message_streaming(user_id, user_message, on_progress)
+    await show(result, partial=False)
     
     # Проверяем, завершён ли диалог
     if result['is_finished']:
@@ -428,7 +600,7 @@ async def handle_dialogue_message(update: Update, context: ContextTypes.DEFAULT_
         )
         
         # Завершаем диалог
-        dialogues.end_dialogue(user_id)
+        await dialogues.end_dialogue(user_id)
         dialogue_states.pop(user_id, None)
         return ConversationHandler.END
     
@@ -456,7 +628,7 @@ async def handle_vocabulary_topic(update: Update, context: ContextTypes.DEFAULT_
     await update.message.reply_text("⏳ Генерирую слова... Это может занять несколько секунд.")
     
     # Генерируем слова
-    success, vocabulary_data = vocabulary_service.generate_words(topic, 10)
+    success, vocabulary_data = await vocabulary_service.generate_words(topic, 10, user_id=user_id)
     
     if not success:
         await update.message.reply_text(f"❌ Ошибка: {vocabulary_data}")
@@ -464,7 +636,7 @@ async def handle_vocabulary_topic(update: Update, context: ContextTypes.DEFAULT_
         return ConversationHandler.END
     
     # Сохраняем слова
-    vocabulary_service.save_words(user_id, vocabulary_data)
+    await vocabulary_service.save_words(user_id, vocabulary_data)
     
     # Форматируем и отправляем
     words_text = vocabulary_service.format_words_compact(vocabulary_data)
@@ -488,10 +660,10 @@ async def handle_vocabulary_topic(update: Update, context: ContextTypes.DEFAULT_
 async def show_history(user_id, message_or_query, is_callback=False):
     """Показать историю пользователя"""
     # Получаем историю тестов
-    test_history = db.get_user_test_history(user_id)
+    test_history = await db.get_user_test_history(user_id)
     
-    # Получаем историю слов
-    vocab_history = vocabulary_service.get_user_vocabulary_history(user_id)
+    # Получаем последние темы (без загрузки самих слов)
+    vocab_history, next_cursor = await vocabulary_service.get_vocabulary_page(user_id, 5)
     
     text = "📊 *Ваша история:*\n\n"
 
@@ -505,12 +677,14 @@ async def show_history(user_id, message_or_query, is_callback=False):
 
     if vocab_history:
         text += "📚 *Изученные темы:*\n"
-        for vocab in vocab_history[:5]:
+        for vocab in vocab_history:
             text += f"• {vocab['topic']} ({vocab['learned_at']})\n"
     else:
         text += "📚 Темы еще не изучены"
 
     keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="menu_back")]]
+    if next_cursor:
+        keyboard.insert(0, [InlineKeyboardButton("📚 Все темы", callback_data="vocab_page")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     if is_callback:
@@ -519,12 +693,278 @@ async def show_history(user_id, message_or_query, is_callback=False):
         await message_or_query.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
 
 
+async def show_vocabulary_page(query, cursor_data):
+    """Показать страницу списка изученных тем (постранично по ключу)"""
+    user_id = query.from_user.id
+    
+    # Курсор передаётся в callback_data как "learned_at|id"
+    before = None
+    if cursor_data:
+        learned_at, last_id = cursor_data.rsplit("|", 1)
+        before = (learned_at, int(last_id))
+    
+    topics, next_cursor = await vocabulary_service.get_vocabulary_page(user_id, HISTORY_PAGE_SIZE, before)
+    
+    if topics:
+        text = "📚 *Изученные темы:*\n\n"
+        for vocab in topics:
+            text += f"• {vocab['topic']} — слов: {vocab['word_count']} ({vocab['learned_at']})\n"
+    else:
+        text = "📚 Больше тем нет"
+    
+    keyboard = []
+    if next_cursor:
+        keyboard.append([InlineKeyboardButton(
+            "Далее ▶️",
+            callback_data=f"vocab_page:{next_cursor[0]}|{next_cursor[1]}"
+        )])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="menu_history")])
+    
+    await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def start_review(user_id, message):
+    """Начать сессию повторения слов"""
+    if not await review_service.start_review(user_id):
+        next_due_at = await review_service.get_next_due_at(user_id)
+        if next_due_at:
+            await message.reply_text(f"🎉 Сейчас повторять нечего. Следующее повторение: {next_due_at} (UTC)")
+        else:
+            await message.reply_text("📚 Пока нечего повторять. Изучите новые слова с /vocabulary")
+        return
+    
+    card = review_service.get_current_card(user_id)
+    keyboard = [[InlineKeyboardButton("👀 Показать перевод", callback_data="review_show")]]
+    await message.reply_text(
+        review_service.format_card_front(card),
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def show_review_answer(query):
+    """Показать перевод карточки и кнопки оценки"""
+    card = review_service.get_current_card(query.from_user.id)
+    if card is None:
+        await query.edit_message_text("Сессия повторения не найдена. Начните заново с /review")
+        return
+    
+    keyboard = [[
+        InlineKeyboardButton(label, callback_data=f"review_grade_{grade}_{card['number']}")
+        for grade, label in review_service.GRADES.items()
+    ]]
+    await query.edit_message_text(
+        review_service.format_card_back(card),
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def grade_review_card(query, grade, number=None):
+    """Сохранить оценку и показать следующую карточку"""
+    user_id = query.from_user.id
+    card = review_service.get_current_card(user_id)
+    if card is not None and number is not None and card['number'] != number:
+        # Повторное нажатие на уже оценённую карточку - не оцениваем следующую вслепую
+        return
+    
+    if not await review_service.grade_card(user_id, grade):
+        await query.edit_message_text("Сессия повторения не найдена. Начните заново с /review")
+        return
+    
+    card = review_service.get_current_card(user_id)
+    if card is None:
+        stats = review_service.finish_review(user_id)
+        await query.edit_message_text(
+            f"🎉 Повторение завершено!\n\n"
+            f"Повторено слов: {stats['reviewed']}\n"
+            f"Вспомнили: {stats['remembered']}/{stats['reviewed']}"
+        )
+        return
+    
+    keyboard = [[InlineKeyboardButton("👀 Показать перевод", callback_data="review_show")]]
+    await query.edit_message_text(
+        review_service.format_card_front(card),
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def review_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /review"""
+    await start_review(update.effective_user.id, update.message)
+
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /find - поиск по изученным словам"""
+    query_text = " ".join(context.args) if context.args else ""
+    if not query_text.strip():
+        await update.message.reply_text("🔍 Укажите, что искать. Например: /find invoice или /find счёт")
+        return
+    
+    results = await vocabulary_service.search_words(update.effective_user.id, query_text)
+    if not results:
+        await update.message.reply_text(f"🔍 Среди изученных слов ничего не найдено по запросу «{query_text}»")
+        return
+    
+    text = f"🔍 Найдено по запросу «{query_text}»:\n\n"
+    for word in results:
+        text += f"• {word['word']} {word['transcription']} — {word['translation']}\n"
+        if word.get('example_en'):
+            text += f"  🇬🇧 {word['example_en']}\n"
+    
+    await update.message.reply_text(text)
+
+
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /history"""
     user_id = update.effective_user.id
     await show_history(user_id, update.message, is_callback=False)
 
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /stats (только для администраторов)"""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    
+    pool_stats = test_pool.get_stats()
+    text = "📈 Статистика\n\n"
+    text += "🧪 Пул тестов:\n"
+    for tense, depth in pool_stats['depth'].items():
+        text += f"• {tense}: {depth}\n"
+    text += f"Попаданий: {pool_stats['hits']}, промахов: {pool_stats['misses']} ({pool_stats['hit_ratio']:.0%})\n"
+    text += f"Сгенерировано: {pool_stats['generated']}, ошибок: {pool_stats['failed']}\n"
+    
+    session_stats = await session_store.get_stats()
+    text += "\n🧠 Состояния пользователей:\n"
+    for name, ns_stats in session_stats['namespaces'].items():
+        text += f"• {name}: {ns_stats['entries']} ({ns_stats['bytes'] // 1024} КБ)\n"
+    text += f"Истекло: {session_stats['expired']}, вытеснено: {session_stats['evicted']}, конфликтов: {session_stats['conflicts']}\n"
+    
+    queue_stats = db.write_queue.get_stats()
+    text += "\n💾 Отложенная запись:\n"
+    text += f"В очереди: {queue_stats['pending']}, транзакций: {queue_stats['flushes']}, строк: {queue_stats['rows']}\n"
+    text += f"Ошибок записи: {queue_stats['failed_rows']}, ожиданий из-за переполнения: {queue_stats['backpressure_waits']}\n"
+    
+    scheduler_stats = GeminiService.get_scheduler().get_stats()
+    breaker_stats = GeminiService.get_circuit_breaker().get_stats()
+    text += f"\n🤖 Запросы к Gemini (выполняется: {scheduler_stats['active']}):\n"
+    text += (
+        f"Выключатель: {breaker_stats['state']}, ошибок подряд: {breaker_stats['failures']}, "
+        f"размыканий: {breaker_stats['opened']}, отклонено: {breaker_stats['rejected']}\n"
+    )
+    for name, class_stats in scheduler_stats['classes'].items():
+        text += (
+            f"• {name}: в очереди {class_stats['queued']}, выполнено {class_stats['granted']}, "
+            f"отброшено {class_stats['shed']}, ожидание {class_stats['avg_wait']} с (макс. {class_stats['max_wait']} с)\n"
+        )
+    
+    text += "\n🧩 Разбор ответов Gemini:\n"
+    for name, mode_stats in parse_stats.get_stats().items():
+        text += (
+            f"• {name}: {mode_stats['total']}, не по формату {mode_stats['parse_failure_rate']:.0%}, "
+            f"повторная генерация {mode_stats['regeneration_rate']:.0%}\n"
+        )
+    for name, repair_stats in parse_stats.get_repair_stats().items():
+        text += (
+            f"• {name}, догенерация: {repair_stats['requests']} раз, "
+            f"получено {repair_stats['recovered']} из {repair_stats['requested']} ({repair_stats['recovery_rate']:.0%})\n"
+        )
+    
+    caches = (
+        ("📚 Кэш слов", vocabulary_service.cache),
+        ("✏️ Кэш проверки грамматики", GeminiService.get_grammar_cache()),
+    )
+    for title, cache in caches:
+        cache_stats = cache.get_stats()
+        text += f"\n{title}:\n"
+        text += f"Записей в памяти: {cache_stats['size']}\n"
+        text += f"Попаданий: {cache_stats['hits']} (из БД: {cache_stats['persistent_hits']}), "
+        text += f"объединено: {cache_stats['coalesced']}, промахов: {cache_stats['misses']} ({cache_stats['hit_ratio']:.0%})\n"
+        text += f"Сэкономлено времени: {cache_stats['saved_seconds']} с\n"
+    
+    await update.message.reply_text(text)
+
+
+def share_conversation_states(handler, name):
+    """Хранить состояния ConversationHandler в SessionStore, а не в памяти процесса.
+    
+    Persistence из python-telegram-bot читает состояния разговоров только при
+    запуске, поэтому разные процессы бота видели бы разные состояния. Здесь они
+    загружаются и сохраняются вместе с остальными состояниями пользователя.
+    Все обработчики блокирующие (block=True), так что в хранилище попадают
+    только номера состояний.
+    """
+    handler._conversations = ConversationStates(session_store, f'conversation_{name}')
+
+
+user_queues = {}  # user_id -> очередь обновлений, ожидающих обработчика этого пользователя
+
+
+class BotApplication(Application):
+    """Приложение, обрабатывающее каждое обновление как единицу работы с состоянием пользователя.
+    
+    Обновления разных пользователей обрабатываются параллельно (CONCURRENT_UPDATES),
+    а обновления одного пользователя - строго по очереди одним обработчиком,
+    поэтому тест, диалог и состояние ConversationHandler не гоняются друг с другом.
+    Обновление, пришедшее во время обработки предыдущего, ставится в очередь
+    пользователя и сразу освобождает слот CONCURRENT_UPDATES: слот занимает
+    только обработчик, который разбирает очередь.
+    
+    При общем хранилище состояний (SESSION_BACKEND=sqlite) состояние пользователя
+    загружается перед вызовом обработчиков и сохраняется после, поэтому
+    обновления одного пользователя могут обрабатывать разные процессы бота
+    (по очереди - под арендой пользователя в общем хранилище).
+    """
+    
+    async def process_update(self, update):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update)
+            return
+        
+        queue = user_queues.get(user.id)
+        if queue is not None:
+            # Обработчик пользователя уже работает - он и разберёт это обновление
+            queue.append(update)
+            return
+        
+        queue = user_queues[user.id] = deque([update])
+        try:
+            while queue:
+                await self.process_user_update(user.id, queue.popleft())
+        finally:
+            del user_queues[user.id]
+    
+    async def process_user_update(self, user_id, update):
+        """Обработать одно обновление пользователя с загрузкой и сохранением его состояния"""
+        try:
+            await session_store.load_user(user_id)
+            try:
+                await super().process_update(update)
+            finally:
+                await session_store.save_user(user_id)
+        except Exception:
+            # Ошибка одного обновления не должна останавливать разбор очереди пользователя
+            logger.exception("Ошибка обработки обновления пользователя %s", user_id)
+
+
+async def post_init(application: Application):
+    """Запуск фоновых задач после инициализации бота"""
+    await test_pool.start()
+    session_store.start()
+    if HEALTH_PORT:
+        await health_server.start()
+
+
+async def post_shutdown(application: Application):
+    """Остановка фоновых задач при завершении бота"""
+    await health_server.stop()
+    await test_pool.stop()
+    await session_store.stop()
+    await AsyncDatabase.close()
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отменить текущее действие и сохранить промежуточный результат"""
     user_id = update.effective_user.id
@@ -532,12 +972,18 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Очищаем состояния
     if user_id in grammar_tests:
         test = grammar_tests[user_id]
+        test.cancel_generation()
         if test.user_answers:
             test_results = test.get_results()
-            db.save_test_result(user_id, test_results, test_results['score'])
+            try:
+                await db.save_test_result(user_id, test_results, test_results['score'], durable=True)
+                saved_text = "💾 Промежуточный результат сохранен.\n"
+            except Exception:
+                logger.exception("Не удалось сохранить результат прерванного теста")
+                saved_text = "⚠️ Не удалось сохранить промежуточный результат.\n"
             message_text = (
                 f"⚠️ Тест прерван.\n"
-                f"💾 Промежуточный результат сохранен.\n"
+                f"{saved_text}"
                 f"✅ Правильных ответов: {test_results['correct_answers']}/{test_results['total_questions']}\n"
                 f"📊 Текущая оценка: {test_results['score']}%"
             )
@@ -548,7 +994,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Если был активный диалог, показываем статистику
     if dialogues.is_active(user_id):
-        stats = dialogues.end_dialogue(user_id)
+        stats = await dialogues.end_dialogue(user_id)
         if stats and stats['total_exchanges'] > 0:
             stats_text = format_dialogue_statistics(stats)
             await update.message.reply_text(
@@ -573,8 +1019,29 @@ def main():
         logger.error("TELEGRAM_BOT_TOKEN не установлен! Создайте файл .env")
         return
     
+    if BOT_MODE not in ('polling', 'webhook'):
+        logger.error("Неизвестный BOT_MODE: %s (ожидается polling или webhook)", BOT_MODE)
+        return
+    
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET_TOKEN:
+        logger.error("WEBHOOK_SECRET_TOKEN не установлен! Он обязателен в режиме webhook")
+        return
+    
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        # Без него PTB соберёт адрес из WEBHOOK_LISTEN и порта (https://0.0.0.0:8443/...) и зарегистрирует его в Telegram
+        logger.error("WEBHOOK_URL не установлен! В режиме webhook нужен публичный адрес, например https://example.com/telegram")
+        return
+    
     # Создаем приложение
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .application_class(BotApplication)
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Обработчик команды /start
     application.add_handler(CommandHandler("start", start))
@@ -595,6 +1062,7 @@ def main():
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
+    share_conversation_states(test_conv_handler, 'test')
     application.add_handler(test_conv_handler)
     
     # ConversationHandler для диалогов (команда /dialogue)
@@ -607,6 +1075,7 @@ def main():
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
+    share_conversation_states(dialogue_conv_handler, 'dialogue')
     application.add_handler(dialogue_conv_handler)
     
     # ConversationHandler для изучения слов (ПЕРЕД универсальным обработчиком!)
@@ -619,6 +1088,7 @@ def main():
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
+    share_conversation_states(vocab_conv_handler, 'vocab')
     application.add_handler(vocab_conv_handler)
     
     # Универсальный обработчик сообщений для состояний через кнопки (добавляется ПОСЛЕДНИМ)
@@ -643,17 +1113,38 @@ def main():
     # Обработчик команды /history
     application.add_handler(CommandHandler("history", history_command))
     
+    # Обработчик команды /review
+    application.add_handler(CommandHandler("review", review_command))
+    
+    # Обработчик команды /find
+    application.add_handler(CommandHandler("find", find_command))
+    
     # Обработчик команды /cancel
     application.add_handler(CommandHandler("cancel", cancel))
     
+    # Обработчик команды /stats
+    application.add_handler(CommandHandler("stats", stats_command))
+    
     # Универсальный обработчик (должен быть ПОСЛЕ всех команд и ConversationHandler)
     application.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
     )
     
     # Запускаем бота
-    logger.info("Бот запущен...")
-    application.run_polling(drop_pending_updates=True)
+    logger.info("Бот запущен (%s)...", BOT_MODE)
+    if BOT_MODE == 'webhook':
+        # Обновления без секрета в заголовке веб-сервер отклоняет с 403.
+        # Ожидающие обновления не сбрасываем: при нескольких репликах
+        # перезапуск одной из них не должен терять сообщения пользователей.
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_URL_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN
+        )
+    else:
+        application.run_polling(drop_pending_updates=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from database import AsyncDatabase
+
+
+class PersistentCache:
+    """Двухуровневый кэш: LRU в памяти + таблица cache_entries в SQLite.
+    
+    Записи живут не дольше ttl секунд. Одновременные запросы одного ключа
+    объединяются в один вызов загрузчика (singleflight).
+    """
+    
+    def __init__(self, namespace, max_size, ttl, persistent_max_size=None):
+        self.db = AsyncDatabase()
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persistent_max_size = persistent_max_size or max_size * 10
+        self.entries = OrderedDict()  # key -> (value, created_at, latency)
+        self.inflight = {}  # key -> задача загрузки
+        self.stats = {
+            'hits': 0,
+            'persistent_hits': 0,
+            'coalesced': 0,
+            'misses': 0,
+            'saved_seconds': 0.0
+        }
+    
+    def get_from_memory(self, key):
+        """Получить значение из памяти без обращения к БД (или None)"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        
+        value, created_at, latency = entry
+        if time.time() - created_at > self.ttl:
+            del self.entries[key]
+            return None
+        
+        self.entries.move_to_end(key)
+        self.stats['hits'] += 1
+        self.stats['saved_seconds'] += latency
+        return value
+    
+    async def get(self, key):
+        """Получить значение из кэша (или None)"""
+        value = self.get_from_memory(key)
+        if value is not None:
+            return value
+        
+        # Второй уровень - SQLite, переживает перезапуск
+        row = await self.db.get_cache_entry(self.namespace, key, time.time() - self.ttl)
+        if row is not None:
+            value = json.loads(row['value'])
+            self._remember(key, value, row['created_at'], row['latency'])
+            self.stats['hits'] += 1
+            self.stats['persistent_hits'] += 1
+            self.stats['saved_seconds'] += row['latency']
+            return value
+        
+        return None
+    
+    async def set(self, key, value, latency=0.0):
+        """Положить значение в кэш"""
+        now = time.time()
+        self._remember(key, value, now, latency)
+        await self.db.set_cache_entry(
+            self.namespace, key, json.dumps(value, ensure_ascii=False), latency, now,
+            self.persistent_max_size
+        )
+    
+    def _remember(self, key, value, created_at, latency):
+        """Сохранить запись в памяти с вытеснением самых старых (LRU)"""
+        self.entries[key] = (value, created_at, latency)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    async def get_or_load(self, key, loader):
+        """Получить значение из кэша или загрузить его.
+        
+        loader - корутина-функция, возвращающая (success, value).
+        В кэш попадают только успешные результаты.
+        """
+        value = self.get_from_memory(key)
+        if value is not None:
+            return True, value
+        
+        # Ключ уже загружается - ждём тот же результат
+        if key in self.inflight:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(self.inflight[key])
+        
+        task = asyncio.ensure_future(self._load(key, loader))
+        self.inflight[key] = task
+        task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task)
+    
+    async def _load(self, key, loader):
+        """Взять значение из БД или вызвать загрузчик и сохранить успешный результат"""
+        value = await self.get(key)
+        if value is not None:
+            return True, value
+        
+        self.stats['misses'] += 1
+        started = time.monotonic()
+        success, value = await loader()
+        if success:
+            await self.set(key, value, time.monotonic() - started)
+        return success, value
+    
+    def get_stats(self):
+        """Получить метрики кэша"""
+        requests = self.stats['hits'] + self.stats['coalesced'] + self.stats['misses']
+        return {
+            'size': len(self.entries),
+            'hits': self.stats['hits'],
+            'persistent_hits': self.stats['persistent_hits'],
+            'coalesced': self.stats['coalesced'],
+            'misses': self.stats['misses'],
+            'hit_ratio': round((self.stats['hits'] + self.stats['coalesced']) / requests, 2) if requests else 0.0,
+            'saved_seconds': round(self.stats['saved_seconds'], 1)
+        }
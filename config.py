@@ -9,10 +9,104 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
 # Gemini API Key
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '')
 
+# Режим получения обновлений: polling (long polling) или webhook (встроенный веб-сервер)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Настройки webhook: адрес и порт веб-сервера, путь, публичный URL и секрет для заголовка
+# X-Telegram-Bot-Api-Secret-Token (обязателен в режиме webhook)
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_URL_PATH = os.getenv('WEBHOOK_URL_PATH', 'telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # обязателен в режиме webhook, например https://example.com/telegram
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+
+# Сколько обновлений обрабатывать одновременно (обновления одного пользователя - всегда по очереди)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Проверка работоспособности (GET /health) на отдельном порту, 0 - отключена
+HEALTH_LISTEN = os.getenv('HEALTH_LISTEN', '0.0.0.0')
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '0'))
+
 # Database file
 DATABASE_FILE = 'bot_database.db'
 
+# Настройки SQLite: размер страничного кэша (КБ) на соединение и кэш подготовленных выражений
+DATABASE_CACHE_SIZE_KB = int(os.getenv('DATABASE_CACHE_SIZE_KB', '16384'))
+DATABASE_STATEMENT_CACHE_SIZE = int(os.getenv('DATABASE_STATEMENT_CACHE_SIZE', '256'))
+# Число потоков для читающих запросов (запись всегда идёт через один поток)
+DATABASE_READER_THREADS = int(os.getenv('DATABASE_READER_THREADS', '4'))
+
+# Отложенная запись диалогов, слов и результатов тестов: пачка раз в N мс или при M строках
+WRITE_BEHIND_FLUSH_INTERVAL_MS = int(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL_MS', '200'))
+WRITE_BEHIND_MAX_BATCH = int(os.getenv('WRITE_BEHIND_MAX_BATCH', '100'))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv('WRITE_BEHIND_MAX_PENDING', '5000'))
+
 # Gemini model
 # Возможные варианты: 'gemini-2.5-flash', 'gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-2.0-flash-exp'
 GEMINI_MODEL = 'gemini-2.5-flash'  # Gemini 2.5 Flash
 
+# Максимальное число одновременных запросов к Gemini
+GEMINI_MAX_CONCURRENT_REQUESTS = int(os.getenv('GEMINI_MAX_CONCURRENT_REQUESTS', '8'))
+
+# Квота Gemini: запросов и токенов модели в минуту (общая для всех функций бота)
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', '60'))
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv('GEMINI_TOKENS_PER_MINUTE', '250000'))
+# Максимальная длина очереди запросов каждого класса (диалог, проверка, слова, тест, пул)
+GEMINI_QUEUE_LIMIT = int(os.getenv('GEMINI_QUEUE_LIMIT', '50'))
+
+# Устойчивость запросов к Gemini: таймаут одной попытки и общий срок (секунды), число повторов
+# временных ошибок и границы экспоненциальной задержки между ними
+GEMINI_ATTEMPT_TIMEOUT = float(os.getenv('GEMINI_ATTEMPT_TIMEOUT', '30'))
+GEMINI_DEADLINE = float(os.getenv('GEMINI_DEADLINE', '60'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '2'))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv('GEMINI_RETRY_BASE_DELAY', '0.5'))
+GEMINI_RETRY_MAX_DELAY = float(os.getenv('GEMINI_RETRY_MAX_DELAY', '8'))
+# Отправлять второй запрос, если первый (реплика, проверка грамматики) дольше обычного p95
+GEMINI_HEDGE_REQUESTS = os.getenv('GEMINI_HEDGE_REQUESTS', '0').lower() in ('1', 'true', 'yes')
+# Выключатель: после N ошибок подряд не обращаться к Gemini указанное число секунд
+GEMINI_BREAKER_FAILURES = int(os.getenv('GEMINI_BREAKER_FAILURES', '5'))
+GEMINI_BREAKER_RESET_TIMEOUT = float(os.getenv('GEMINI_BREAKER_RESET_TIMEOUT', '30'))
+
+# Структурированные ответы Gemini (JSON по схеме) вместо разбора свободного текста
+GEMINI_STRUCTURED_OUTPUT = os.getenv('GEMINI_STRUCTURED_OUTPUT', '0').lower() in ('1', 'true', 'yes')
+
+# Таймауты (в секундах) для запросов в диалоге; они же служат общим сроком запроса к Gemini
+# вместо GEMINI_DEADLINE, чтобы повторы не продолжались после того, как диалог перестал ждать
+GRAMMAR_CHECK_TIMEOUT = float(os.getenv('GRAMMAR_CHECK_TIMEOUT', '15'))
+DIALOGUE_REPLY_TIMEOUT = float(os.getenv('DIALOGUE_REPLY_TIMEOUT', '20'))
+
+# Минимальный интервал (в секундах) между правками сообщения при потоковом ответе в диалоге
+# (Telegram ограничивает частоту редактирования сообщений в одном чате)
+DIALOGUE_EDIT_INTERVAL = float(os.getenv('DIALOGUE_EDIT_INTERVAL', '1.0'))
+
+# Пул заранее сгенерированных тестов (на каждый тип времён)
+TEST_POOL_LOW_WATERMARK = int(os.getenv('TEST_POOL_LOW_WATERMARK', '2'))
+TEST_POOL_HIGH_WATERMARK = int(os.getenv('TEST_POOL_HIGH_WATERMARK', '5'))
+TEST_POOL_REFILL_INTERVAL = float(os.getenv('TEST_POOL_REFILL_INTERVAL', '30'))
+
+# Telegram ID администраторов (через запятую) - им доступна команда /stats
+ADMIN_USER_IDS = {int(x) for x in os.getenv('ADMIN_USER_IDS', '').split(',') if x.strip()}
+
+# Кэш сгенерированных слов по теме
+VOCABULARY_CACHE_SIZE = int(os.getenv('VOCABULARY_CACHE_SIZE', '200'))
+VOCABULARY_CACHE_PERSISTENT_SIZE = int(os.getenv('VOCABULARY_CACHE_PERSISTENT_SIZE', '2000'))
+VOCABULARY_CACHE_TTL = int(os.getenv('VOCABULARY_CACHE_TTL', str(7 * 24 * 3600)))
+
+# Кэш результатов проверки грамматики (ключ - текст без учёта регистра и пунктуации)
+GRAMMAR_CACHE_SIZE = int(os.getenv('GRAMMAR_CACHE_SIZE', '2000'))
+GRAMMAR_CACHE_PERSISTENT_SIZE = int(os.getenv('GRAMMAR_CACHE_PERSISTENT_SIZE', '20000'))
+GRAMMAR_CACHE_TTL = int(os.getenv('GRAMMAR_CACHE_TTL', str(30 * 24 * 3600)))
+GRAMMAR_CACHE_MAX_TEXT_LENGTH = int(os.getenv('GRAMMAR_CACHE_MAX_TEXT_LENGTH', '200'))
+
+# Максимальное число карточек в одной сессии повторения (/review)
+REVIEW_SESSION_SIZE = int(os.getenv('REVIEW_SESSION_SIZE', '20'))
+
+# Хранилище состояний пользователей (тесты, диалоги, текущие слова)
+# memory - в памяти процесса, sqlite - общая таблица в DATABASE_FILE для нескольких процессов бота
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '10000'))
+SESSION_TTL = int(os.getenv('SESSION_TTL', '3600'))  # секунд с последнего обращения
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', '60'))
+# Срок аренды пользователя процессом (секунды): дольше обработка одного обновления идти не должна,
+# иначе аренда истечёт и обновление того же пользователя сможет взять другой процесс
+SESSION_LEASE_TIMEOUT = float(os.getenv('SESSION_LEASE_TIMEOUT', '300'))
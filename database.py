@@ -1,17 +1,302 @@
 import sqlite3
 import json
-from datetime import datetime
-from config import DATABASE_FILE
+import hashlib
+import re
+import random
+import threading
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from config import (
+    DATABASE_FILE,
+    DATABASE_CACHE_SIZE_KB,
+    DATABASE_STATEMENT_CACHE_SIZE,
+    DATABASE_READER_THREADS,
+    WRITE_BEHIND_FLUSH_INTERVAL_MS,
+    WRITE_BEHIND_MAX_BATCH,
+    WRITE_BEHIND_MAX_PENDING
+)
+
+
+def word_lemma(word):
+    """Нормализованная форма слова для словаря: нижний регистр, без артиклей и частицы to"""
+    lemma = re.sub(r"[^\w\s'-]", '', word.lower())
+    lemma = re.sub(r'\s+', ' ', lemma).strip()
+    return re.sub(r'^(?:to|a|an|the) ', '', lemma)
+
+
+def migrate_vocabulary_words(cursor):
+    """Миграция 3: разложить сохранённые JSON-списки слов по таблицам words и user_words"""
+    cursor.execute('SELECT user_id, words, learned_at FROM vocabulary ORDER BY id')
+    for user_id, words_json, learned_at in cursor.fetchall():
+        try:
+            words = json.loads(words_json)
+        except (TypeError, ValueError):
+            continue
+        for sql, params in Database.word_statements(user_id, words, learned_at):
+            cursor.execute(sql, params)
 
 
 class Database:
+    # Вставки, которые можно копить и выполнять пачкой (см. write_behind.WriteBehindQueue)
+    INSERT_DIALOGUE = '''
+        INSERT INTO dialogues (user_id, messages)
+        VALUES (?, ?)
+    '''
+    INSERT_VOCABULARY = '''
+        INSERT INTO vocabulary (user_id, topic, words, word_count)
+        VALUES (?, ?, ?, ?)
+    '''
+    INSERT_WORD = '''
+        INSERT OR IGNORE INTO words (lemma, word, transcription, translation, example_en, example_ru)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''
+    INSERT_USER_WORD = '''
+        INSERT OR IGNORE INTO user_words (user_id, word_id, learned_at)
+        SELECT ?, id, COALESCE(?, CURRENT_TIMESTAMP) FROM words WHERE lemma = ?
+    '''
+    # Пересчёт карточки по алгоритму SM-2 по оценке ответа (0-5) целиком в SQL,
+    # поэтому оценки многих пользователей применяются одним executemany.
+    # Отдельного фонового задания для массового пересчёта нет: эту роль играет
+    # пачка очереди отложенной записи (см. save_review)
+    REVIEW_USER_WORD = '''
+        UPDATE user_words SET
+            interval_days = CASE
+                WHEN :grade < 3 THEN 1
+                WHEN repetitions = 0 THEN 1
+                WHEN repetitions = 1 THEN 6
+                ELSE ROUND(interval_days * ease)
+            END,
+            due_at = datetime(:reviewed_at, '+' || CASE
+                WHEN :grade < 3 THEN 1
+                WHEN repetitions = 0 THEN 1
+                WHEN repetitions = 1 THEN 6
+                ELSE ROUND(interval_days * ease)
+            END || ' days'),
+            repetitions = CASE WHEN :grade < 3 THEN 0 ELSE repetitions + 1 END,
+            ease = MAX(1.3, ease + 0.1 - (5 - :grade) * (0.08 + (5 - :grade) * 0.02)),
+            reviewed_at = :reviewed_at
+        WHERE user_id = :user_id AND word_id = :word_id
+    '''
+    INSERT_TEST_RESULT = '''
+        INSERT INTO grammar_tests (user_id, test_data, score)
+        VALUES (?, ?, ?)
+    '''
+    # Запросы истории пользователя (их планы проверяются в test_database.py)
+    SELECT_TEST_HISTORY = '''
+        SELECT score, completed_at
+        FROM grammar_tests
+        WHERE user_id = ?
+        ORDER BY completed_at DESC
+        LIMIT 10
+    '''
+    SELECT_USER_VOCABULARY = '''
+        SELECT topic, words, learned_at
+        FROM vocabulary
+        WHERE user_id = ?
+        ORDER BY learned_at DESC
+    '''
+    # Непросмотренные вопросы банка в диапазоне id: для "all" - по первичному ключу,
+    # для конкретного типа времён - по индексу idx_questions_tense (он упорядочен по id)
+    SELECT_UNSEEN_QUESTIONS = '''
+        SELECT q.id, q.question, q.options, q.correct_answer, q.explanation, q.difficulty
+        FROM questions q
+        WHERE q.id >= ? AND q.id < ?
+          AND NOT EXISTS (
+              SELECT 1 FROM user_questions uq
+              WHERE uq.user_id = ? AND uq.question_id = q.id
+          )
+        ORDER BY q.id
+        LIMIT ?
+    '''
+    SELECT_UNSEEN_QUESTIONS_BY_TENSE = '''
+        SELECT q.id, q.question, q.options, q.correct_answer, q.explanation, q.difficulty
+        FROM questions q
+        WHERE q.tense_type = ? AND q.id >= ? AND q.id < ?
+          AND NOT EXISTS (
+              SELECT 1 FROM user_questions uq
+              WHERE uq.user_id = ? AND uq.question_id = q.id
+          )
+        ORDER BY q.id
+        LIMIT ?
+    '''
+    
+    # Версионированные миграции схемы: номер версии = индекс в списке + 1.
+    # Применённая версия хранится в PRAGMA user_version. Новые миграции добавляются только в конец.
+    MIGRATIONS = [
+        # 1: индексы для истории пользователя (покрывают выборку без чтения строк таблицы)
+        [
+            '''
+            CREATE INDEX IF NOT EXISTS idx_grammar_tests_user_completed
+            ON grammar_tests (user_id, completed_at DESC, score)
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_vocabulary_user_learned
+            ON vocabulary (user_id, learned_at DESC, topic)
+            ''',
+        ],
+        # 2: число слов хранится отдельно, чтобы список тем не требовал разбора JSON
+        [
+            'ALTER TABLE vocabulary ADD COLUMN word_count INTEGER DEFAULT 0',
+            'UPDATE vocabulary SET word_count = json_array_length(words)',
+            'DROP INDEX IF EXISTS idx_vocabulary_user_learned',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_vocabulary_user_summary
+            ON vocabulary (user_id, learned_at DESC, id DESC, topic, word_count)
+            ''',
+        ],
+        # 3: словарь слов (одна строка на лемму) и слова, изученные пользователем
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS words (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                lemma TEXT UNIQUE NOT NULL,
+                word TEXT,
+                transcription TEXT,
+                translation TEXT,
+                example_en TEXT,
+                example_ru TEXT
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS user_words (
+                user_id INTEGER,
+                word_id INTEGER,
+                learned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, word_id),
+                FOREIGN KEY (user_id) REFERENCES users (user_id),
+                FOREIGN KEY (word_id) REFERENCES words (id)
+            ) WITHOUT ROWID
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_user_words_word ON user_words (word_id)',
+            migrate_vocabulary_words,
+        ],
+        # 4: интервальное повторение (SM-2) - дата следующего повторения с индексом
+        [
+            'ALTER TABLE user_words ADD COLUMN due_at TIMESTAMP',
+            'ALTER TABLE user_words ADD COLUMN interval_days REAL DEFAULT 0',
+            'ALTER TABLE user_words ADD COLUMN ease REAL DEFAULT 2.5',
+            'ALTER TABLE user_words ADD COLUMN repetitions INTEGER DEFAULT 0',
+            'ALTER TABLE user_words ADD COLUMN reviewed_at TIMESTAMP',
+            "UPDATE user_words SET due_at = datetime(learned_at, '+1 day')",
+            '''
+            CREATE TRIGGER IF NOT EXISTS user_words_set_due
+            AFTER INSERT ON user_words
+            WHEN NEW.due_at IS NULL
+            BEGIN
+                UPDATE user_words SET due_at = datetime(NEW.learned_at, '+1 day')
+                WHERE user_id = NEW.user_id AND word_id = NEW.word_id;
+            END
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_user_words_due ON user_words (user_id, due_at)',
+        ],
+        # 5: полнотекстовый поиск по словам, переводам и примерам (FTS5 поверх таблицы words)
+        [
+            '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS words_fts USING fts5(
+                word, translation, example_en, example_ru,
+                content='words', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS words_fts_insert
+            AFTER INSERT ON words
+            BEGIN
+                INSERT INTO words_fts (rowid, word, translation, example_en, example_ru)
+                VALUES (NEW.id, NEW.word, NEW.translation, NEW.example_en, NEW.example_ru);
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS words_fts_delete
+            AFTER DELETE ON words
+            BEGIN
+                INSERT INTO words_fts (words_fts, rowid, word, translation, example_en, example_ru)
+                VALUES ('delete', OLD.id, OLD.word, OLD.translation, OLD.example_en, OLD.example_ru);
+            END
+            ''',
+            "INSERT INTO words_fts (words_fts) VALUES ('rebuild')",
+        ],
+        # 6: общие состояния пользователей для нескольких процессов бота (см. session_store)
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS sessions (
+                namespace TEXT,
+                user_id INTEGER,
+                value TEXT,
+                version INTEGER,
+                touched_at REAL,
+                PRIMARY KEY (namespace, user_id)
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_sessions_touched ON sessions (namespace, touched_at)',
+        ],
+        # 7: выборка вопросов банка по типу времён в порядке id (для случайной выборки без ORDER BY RANDOM())
+        [
+            'CREATE INDEX IF NOT EXISTS idx_questions_tense ON questions (tense_type)',
+        ],
+        # 8: аренда пользователя процессом бота - обновления одного пользователя обрабатываются по очереди
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS session_leases (
+                user_id INTEGER PRIMARY KEY,
+                owner TEXT,
+                expires_at REAL
+            )
+            ''',
+        ],
+    ]
+    
+    # Соединения переиспользуются: одно на поток и файл БД (общие для всех экземпляров)
+    _local = threading.local()
+    # Файлы, для которых схема уже создана в этом процессе
+    _initialized_files = set()
+    _init_lock = threading.Lock()
+    
     def __init__(self):
         self.db_file = DATABASE_FILE
-        self.init_database()
+        with self._init_lock:
+            if self.db_file not in self._initialized_files:
+                self.init_database()
+                self._initialized_files.add(self.db_file)
     
     def get_connection(self):
-        """Получить соединение с базой данных"""
-        return sqlite3.connect(self.db_file)
+        """Получить соединение с базой данных текущего потока"""
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        
+        conn = connections.get(self.db_file)
+        if conn is None:
+            conn = self.open_connection()
+            connections[self.db_file] = conn
+        elif conn.in_transaction:
+            # Предыдущий вызов упал посреди транзакции - не даём ей закоммититься случайно
+            conn.rollback()
+        
+        return conn
+    
+    def open_connection(self):
+        """Открыть новое соединение с WAL и настроенным кэшем.
+        
+        Повторяющиеся SQL-запросы берутся из кэша подготовленных выражений sqlite3
+        (cached_statements), поэтому не компилируются заново.
+        """
+        conn = sqlite3.connect(self.db_file, cached_statements=DATABASE_STATEMENT_CACHE_SIZE)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = -{DATABASE_CACHE_SIZE_KB}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA busy_timeout = 5000')
+        return conn
+    
+    def close_connection(self):
+        """Закрыть соединение текущего потока (например, при остановке бота)"""
+        connections = getattr(self._local, 'connections', {})
+        conn = connections.pop(self.db_file, None)
+        if conn is not None:
+            conn.close()
     
     def init_database(self):
         """Инициализировать таблицы базы данных"""
@@ -63,8 +348,121 @@ class Database:
             )
         ''')
         
+        # Таблица пула заранее сгенерированных тестов
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS test_pool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tense_type TEXT,
+                questions TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Банк вопросов: каждый вопрос хранится один раз (уникальный хэш нормализованного текста)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS questions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text_hash TEXT UNIQUE,
+                tense_type TEXT,
+                difficulty TEXT,
+                question TEXT,
+                options TEXT,
+                correct_answer TEXT,
+                explanation TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_questions_tense_difficulty
+            ON questions (tense_type, difficulty)
+        ''')
+        
+        # Какие вопросы из банка пользователь уже видел
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_questions (
+                user_id INTEGER,
+                question_id INTEGER,
+                seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, question_id),
+                FOREIGN KEY (user_id) REFERENCES users (user_id),
+                FOREIGN KEY (question_id) REFERENCES questions (id)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Постоянный уровень кэшей (см. cache.PersistentCache)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT,
+                key TEXT,
+                value TEXT,
+                latency REAL,
+                created_at REAL,
+                last_used_at REAL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_cache_entries_last_used
+            ON cache_entries (namespace, last_used_at)
+        ''')
+        
         conn.commit()
-        conn.close()
+        
+        self.apply_migrations()
+    
+    def apply_migrations(self):
+        """Применить миграции, которых ещё нет в этой БД.
+        
+        Каждая миграция выполняется в своей транзакции BEGIN IMMEDIATE вместе с
+        обновлением user_version: сбой посреди миграции откатывает её целиком, а
+        процесс, запущенный одновременно с другим, ждёт блокировку записи и
+        перечитывает версию, чтобы не применить ту же миграцию второй раз.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        applied = cursor.execute('PRAGMA user_version').fetchone()[0]
+        
+        for number in range(applied + 1, len(self.MIGRATIONS) + 1):
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                version = cursor.execute('PRAGMA user_version').fetchone()[0]
+                if version >= number:
+                    conn.rollback()
+                    continue
+                
+                for step in self.MIGRATIONS[number - 1]:
+                    # Шаг миграции - SQL-запрос или функция, получающая курсор
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute(f'PRAGMA user_version = {number}')
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+    
+    def explain_query_plan(self, sql, params=()):
+        """Получить план выполнения запроса (строки detail из EXPLAIN QUERY PLAN).
+        
+        Позволяет проверить, что запрос использует индекс, например:
+        'SEARCH grammar_tests USING COVERING INDEX idx_grammar_tests_user_completed (user_id=?)'
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [row[3] for row in cursor.fetchall()]
+    
+    @staticmethod
+    def question_hash(question):
+        """Хэш нормализованного текста вопроса и вариантов ответа"""
+        parts = [question['question']] + [question['options'].get(key, '') for key in 'abcd']
+        text = ' | '.join(parts).lower()
+        text = re.sub(r'[^\w|]+', ' ', text)
+        text = re.sub(r'\s+', ' ', text).strip()
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
     
     def add_user(self, user_id, username=None, first_name=None):
         """Добавить пользователя в базу данных"""
@@ -77,7 +475,6 @@ class Database:
         ''', (user_id, username, first_name))
         
         conn.commit()
-        conn.close()
     
     def save_dialogue(self, user_id, messages):
         """Сохранить диалог пользователя"""
@@ -85,13 +482,33 @@ class Database:
         cursor = conn.cursor()
         
         messages_json = json.dumps(messages, ensure_ascii=False)
-        cursor.execute('''
-            INSERT INTO dialogues (user_id, messages)
-            VALUES (?, ?)
-        ''', (user_id, messages_json))
+        cursor.execute(self.INSERT_DIALOGUE, (user_id, messages_json))
         
         conn.commit()
-        conn.close()
+    
+    @classmethod
+    def word_statements(cls, user_id, words, learned_at=None):
+        """Запросы для записи слов в словарь и в список изученных пользователем.
+        
+        Сначала идут все вставки в words, затем в user_words - так очередь
+        отложенной записи выполнит их двумя executemany.
+        """
+        word_rows = []
+        user_word_rows = []
+        for word in words:
+            lemma = word_lemma(word.get('word', ''))
+            if not lemma:
+                continue
+            word_rows.append((cls.INSERT_WORD, (
+                lemma,
+                word.get('word', ''),
+                word.get('transcription', ''),
+                word.get('translation', ''),
+                word.get('example_en', ''),
+                word.get('example_ru', '')
+            )))
+            user_word_rows.append((cls.INSERT_USER_WORD, (user_id, learned_at, lemma)))
+        return word_rows + user_word_rows
     
     def save_vocabulary(self, user_id, topic, words):
         """Сохранить слова по теме для пользователя"""
@@ -99,28 +516,20 @@ class Database:
         cursor = conn.cursor()
         
         words_json = json.dumps(words, ensure_ascii=False)
-        cursor.execute('''
-            INSERT INTO vocabulary (user_id, topic, words)
-            VALUES (?, ?, ?)
-        ''', (user_id, topic, words_json))
+        cursor.execute(self.INSERT_VOCABULARY, (user_id, topic, words_json, len(words)))
+        for sql, params in self.word_statements(user_id, words):
+            cursor.execute(sql, params)
         
         conn.commit()
-        conn.close()
     
     def get_user_vocabulary(self, user_id):
         """Получить все сохраненные слова пользователя"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT topic, words, learned_at
-            FROM vocabulary
-            WHERE user_id = ?
-            ORDER BY learned_at DESC
-        ''', (user_id,))
+        cursor.execute(self.SELECT_USER_VOCABULARY, (user_id,))
         
         results = cursor.fetchall()
-        conn.close()
         
         return [
             {
@@ -131,35 +540,308 @@ class Database:
             for row in results
         ]
     
+    def get_user_vocabulary_summary(self, user_id, limit, before=None):
+        """Получить темы пользователя без самих слов (тема, число слов, дата).
+        
+        Постраничная выборка по ключу: before - (learned_at, id) последней
+        записи предыдущей страницы. Запрос обслуживается покрывающим индексом.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        if before is None:
+            cursor.execute('''
+                SELECT id, topic, word_count, learned_at
+                FROM vocabulary
+                WHERE user_id = ?
+                ORDER BY learned_at DESC, id DESC
+                LIMIT ?
+            ''', (user_id, limit))
+        else:
+            cursor.execute('''
+                SELECT id, topic, word_count, learned_at
+                FROM vocabulary
+                WHERE user_id = ? AND (learned_at, id) < (?, ?)
+                ORDER BY learned_at DESC, id DESC
+                LIMIT ?
+            ''', (user_id, before[0], before[1], limit))
+        
+        results = cursor.fetchall()
+        
+        return [
+            {
+                'id': row[0],
+                'topic': row[1],
+                'word_count': row[2],
+                'learned_at': row[3]
+            }
+            for row in results
+        ]
+    
+    def get_learned_lemmas(self, user_id, lemmas):
+        """Получить те из лемм, которые пользователь уже изучил (поиск по индексам)"""
+        if not lemmas:
+            return set()
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        placeholders = ', '.join('?' * len(lemmas))
+        cursor.execute(f'''
+            SELECT w.lemma
+            FROM words w
+            JOIN user_words uw ON uw.word_id = w.id AND uw.user_id = ?
+            WHERE w.lemma IN ({placeholders})
+        ''', (user_id, *lemmas))
+        
+        return {row[0] for row in cursor.fetchall()}
+    
+    def count_learned_words(self, user_id):
+        """Получить число различных слов, изученных пользователем"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT COUNT(*) FROM user_words WHERE user_id = ?', (user_id,))
+        return cursor.fetchone()[0]
+    
+    def get_due_words(self, user_id, limit):
+        """Получить карточки, которые пора повторить (диапазон по индексу (user_id, due_at))"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT w.id, w.word, w.transcription, w.translation, w.example_en, w.example_ru, uw.due_at
+            FROM user_words uw
+            JOIN words w ON w.id = uw.word_id
+            WHERE uw.user_id = ? AND uw.due_at <= datetime('now')
+            ORDER BY uw.due_at
+            LIMIT ?
+        ''', (user_id, limit))
+        
+        results = cursor.fetchall()
+        
+        return [
+            {
+                'word_id': row[0],
+                'word': row[1],
+                'transcription': row[2],
+                'translation': row[3],
+                'example_en': row[4],
+                'example_ru': row[5],
+                'due_at': row[6]
+            }
+            for row in results
+        ]
+    
+    def get_next_due_at(self, user_id):
+        """Получить дату ближайшего повторения (или None)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT MIN(due_at) FROM user_words WHERE user_id = ?', (user_id,))
+        return cursor.fetchone()[0]
+    
+    def save_reviews(self, reviews):
+        """Применить оценки повторений пачкой.
+        
+        reviews - список словарей с ключами user_id, word_id, grade, reviewed_at
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.executemany(self.REVIEW_USER_WORD, reviews)
+        
+        conn.commit()
+    
+    @staticmethod
+    def fts_query(text):
+        """Превратить ввод пользователя в безопасный запрос FTS5 (все слова, поиск по префиксу)"""
+        tokens = re.findall(r'\w+', text.lower())
+        return ' '.join(f'"{token}"*' for token in tokens)
+    
+    def search_user_words(self, user_id, text, limit):
+        """Найти изученные пользователем слова по слову, переводу или примерам (ранжирование bm25)"""
+        query = self.fts_query(text)
+        if not query:
+            return []
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT w.word, w.transcription, w.translation, w.example_en, w.example_ru
+            FROM words_fts
+            JOIN words w ON w.id = words_fts.rowid
+            JOIN user_words uw ON uw.word_id = w.id AND uw.user_id = ?
+            WHERE words_fts MATCH ?
+            ORDER BY bm25(words_fts)
+            LIMIT ?
+        ''', (user_id, query, limit))
+        
+        results = cursor.fetchall()
+        
+        return [
+            {
+                'word': row[0],
+                'transcription': row[1],
+                'translation': row[2],
+                'example_en': row[3],
+                'example_ru': row[4]
+            }
+            for row in results
+        ]
+    
+    def get_user_sessions(self, user_id):
+        """Получить все состояния пользователя: {namespace: (value, version)}"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT namespace, value, version
+            FROM sessions
+            WHERE user_id = ?
+        ''', (user_id,))
+        
+        return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+    
+    def save_user_sessions(self, user_id, writes, deletes, touches, touched_at):
+        """Записать состояния пользователя одной транзакцией с оптимистичной блокировкой.
+        
+        writes - список (namespace, value, version): version=None для новой записи,
+        иначе запись обновится, только если её версия в БД не изменилась.
+        deletes - список (namespace, version), touches - список namespace.
+        Возвращает список namespace, в которых обнаружен конфликт версий.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        conflicts = []
+        
+        for namespace, value, version in writes:
+            if version is None:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO sessions (namespace, user_id, value, version, touched_at)
+                    VALUES (?, ?, ?, 1, ?)
+                ''', (namespace, user_id, value, touched_at))
+            else:
+                cursor.execute('''
+                    UPDATE sessions SET value = ?, version = version + 1, touched_at = ?
+                    WHERE namespace = ? AND user_id = ? AND version = ?
+                ''', (value, touched_at, namespace, user_id, version))
+            if cursor.rowcount == 0:
+                conflicts.append(namespace)
+        
+        for namespace, version in deletes:
+            cursor.execute('''
+                DELETE FROM sessions
+                WHERE namespace = ? AND user_id = ? AND version = ?
+            ''', (namespace, user_id, version))
+        
+        for namespace in touches:
+            cursor.execute('''
+                UPDATE sessions SET touched_at = ?
+                WHERE namespace = ? AND user_id = ?
+            ''', (touched_at, namespace, user_id))
+        
+        conn.commit()
+        return conflicts
+    
+    def acquire_session_lease(self, user_id, owner, now, expires_at):
+        """Взять аренду пользователя, если она свободна или истекла"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO session_leases (user_id, owner, expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE session_leases.expires_at < ?
+        ''', (user_id, owner, expires_at, now))
+        acquired = cursor.rowcount > 0
+        
+        conn.commit()
+        return acquired
+    
+    def release_session_lease(self, user_id, owner):
+        """Вернуть аренду пользователя (если она ещё принадлежит owner)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM session_leases WHERE user_id = ? AND owner = ?', (user_id, owner))
+        conn.commit()
+    
+    def take_expired_sessions(self, namespace, min_touched_at):
+        """Удалить истёкшие состояния и вернуть их [(user_id, value)]"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT user_id, value, version
+            FROM sessions
+            WHERE namespace = ? AND touched_at < ?
+        ''', (namespace, min_touched_at))
+        
+        expired = []
+        for user_id, value, version in cursor.fetchall():
+            # Другой процесс мог успеть обновить или забрать запись
+            cursor.execute('''
+                DELETE FROM sessions
+                WHERE namespace = ? AND user_id = ? AND version = ?
+            ''', (namespace, user_id, version))
+            if cursor.rowcount:
+                expired.append((user_id, value))
+        
+        conn.commit()
+        return expired
+    
+    def get_session_stats(self):
+        """Получить число состояний и их размер по namespace"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT namespace, COUNT(*), COALESCE(SUM(LENGTH(value)), 0)
+            FROM sessions
+            GROUP BY namespace
+        ''')
+        
+        return {row[0]: {'entries': row[1], 'bytes': row[2]} for row in cursor.fetchall()}
+    
     def save_test_result(self, user_id, test_data, score):
         """Сохранить результат теста"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
         test_json = json.dumps(test_data, ensure_ascii=False)
-        cursor.execute('''
-            INSERT INTO grammar_tests (user_id, test_data, score)
-            VALUES (?, ?, ?)
-        ''', (user_id, test_json, score))
+        cursor.execute(self.INSERT_TEST_RESULT, (user_id, test_json, score))
+        
+        conn.commit()
+    
+    def execute_batch(self, statements):
+        """Выполнить пачку вставок одной транзакцией.
+        
+        statements - список пар (sql, список строк параметров)
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            for sql, rows in statements:
+                cursor.executemany(sql, rows)
+        except Exception:
+            # Пачка не должна оставить часть строк в открытой транзакции - их запишет следующий commit
+            conn.rollback()
+            raise
         
         conn.commit()
-        conn.close()
     
     def get_user_test_history(self, user_id):
         """Получить историю тестов пользователя"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT score, completed_at
-            FROM grammar_tests
-            WHERE user_id = ?
-            ORDER BY completed_at DESC
-            LIMIT 10
-        ''', (user_id,))
+        cursor.execute(self.SELECT_TEST_HISTORY, (user_id,))
         
         results = cursor.fetchall()
-        conn.close()
         
         return [
             {
@@ -167,4 +849,373 @@ class Database:
                 'completed_at': row[1]
             }
             for row in results
-        ]
\ No newline at end of file
+        ]
+    
+    def save_pooled_test(self, tense_type, questions):
+        """Сохранить готовый тест в пул и вернуть его id"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        questions_json = json.dumps(questions, ensure_ascii=False)
+        cursor.execute('''
+            INSERT INTO test_pool (tense_type, questions)
+            VALUES (?, ?)
+        ''', (tense_type, questions_json))
+        test_id = cursor.lastrowid
+        
+        conn.commit()
+        
+        return test_id
+    
+    def get_pooled_tests(self):
+        """Получить все тесты из пула (старые первыми)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, tense_type, questions
+            FROM test_pool
+            ORDER BY id
+        ''')
+        
+        results = cursor.fetchall()
+        
+        return [
+            {
+                'id': row[0],
+                'tense_type': row[1],
+                'questions': json.loads(row[2])
+            }
+            for row in results
+        ]
+    
+    def delete_pooled_test(self, test_id):
+        """Удалить выданный тест из пула"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM test_pool WHERE id = ?', (test_id,))
+        
+        conn.commit()
+    
+    def save_questions(self, questions, tense_type):
+        """Сохранить вопросы в банк и проставить им id (в т.ч. уже существующим)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        for question in questions:
+            text_hash = self.question_hash(question)
+            cursor.execute('''
+                INSERT OR IGNORE INTO questions
+                    (text_hash, tense_type, difficulty, question, options, correct_answer, explanation)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                text_hash,
+                tense_type,
+                question.get('difficulty', 'medium'),
+                question['question'],
+                json.dumps(question['options'], ensure_ascii=False),
+                question['correct_answer'],
+                question.get('explanation', '')
+            ))
+            cursor.execute('SELECT id FROM questions WHERE text_hash = ?', (text_hash,))
+            question['id'] = cursor.fetchone()[0]
+        
+        conn.commit()
+    
+    def get_unseen_questions(self, user_id, tense_type, limit):
+        """Получить случайные вопросы из банка, которые пользователь ещё не видел.
+        
+        Вместо ORDER BY RANDOM() (полный просмотр и сортировка банка) выбирается
+        случайный id, с которого читаются непросмотренные вопросы по индексу;
+        если до конца банка их не хватило, чтение продолжается с начала.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        first_id, last_id = cursor.execute('SELECT MIN(id), MAX(id) FROM questions').fetchone()
+        if first_id is None:
+            return []
+        start_id = random.randint(first_id, last_id)
+        
+        results = []
+        for low, high in ((start_id, last_id + 1), (first_id, start_id)):
+            if len(results) >= limit:
+                break
+            # Для "all" подходят вопросы любого типа времён
+            if tense_type == 'all':
+                cursor.execute(self.SELECT_UNSEEN_QUESTIONS, (low, high, user_id, limit - len(results)))
+            else:
+                cursor.execute(
+                    self.SELECT_UNSEEN_QUESTIONS_BY_TENSE,
+                    (tense_type, low, high, user_id, limit - len(results))
+                )
+            results.extend(cursor.fetchall())
+        
+        # Вопросы идут подряд по id - перемешиваем порядок внутри теста
+        random.shuffle(results)
+        
+        return [
+            {
+                'id': row[0],
+                'question': row[1],
+                'options': json.loads(row[2]),
+                'correct_answer': row[3],
+                'explanation': row[4],
+                'difficulty': row[5]
+            }
+            for row in results
+        ]
+    
+    def mark_questions_seen(self, user_id, question_ids):
+        """Отметить вопросы банка как показанные пользователю"""
+        if not question_ids:
+            return
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.executemany('''
+            INSERT OR IGNORE INTO user_questions (user_id, question_id)
+            VALUES (?, ?)
+        ''', [(user_id, question_id) for question_id in question_ids])
+        
+        conn.commit()
+    
+    def get_cache_entry(self, namespace, key, min_created_at):
+        """Получить непросроченную запись кэша и обновить время использования"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT value, latency, created_at
+            FROM cache_entries
+            WHERE namespace = ? AND key = ? AND created_at >= ?
+        ''', (namespace, key, min_created_at))
+        row = cursor.fetchone()
+        
+        if row is not None:
+            cursor.execute('''
+                UPDATE cache_entries SET last_used_at = ?
+                WHERE namespace = ? AND key = ?
+            ''', (datetime.now().timestamp(), namespace, key))
+            conn.commit()
+        
+        if row is None:
+            return None
+        return {'value': row[0], 'latency': row[1], 'created_at': row[2]}
+    
+    def set_cache_entry(self, namespace, key, value, latency, created_at, max_entries):
+        """Сохранить запись кэша, вытеснив давно не использованные сверх лимита"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT OR REPLACE INTO cache_entries
+                (namespace, key, value, latency, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (namespace, key, value, latency, created_at, created_at))
+        
+        cursor.execute('''
+            DELETE FROM cache_entries
+            WHERE namespace = ? AND key IN (
+                SELECT key FROM cache_entries
+                WHERE namespace = ?
+                ORDER BY last_used_at DESC
+                LIMIT -1 OFFSET ?
+            )
+        ''', (namespace, namespace, max_entries))
+        
+        conn.commit()
+
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database для вызова из обработчиков бота.
+    
+    Запросы выполняются в отдельных потоках, а не в event loop: все записи идут
+    через один поток-писатель (SQLite всё равно допускает одного писателя),
+    чтения - через небольшой пул потоков. У каждого потока своё соединение
+    (см. Database.get_connection), WAL позволяет читать во время записи.
+    """
+    
+    # Потоки и очередь отложенной записи общие для всех экземпляров
+    _writer = None
+    _readers = None
+    _write_queue = None
+    
+    def __init__(self):
+        self.database = Database()
+        if AsyncDatabase._writer is None:
+            AsyncDatabase._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+            AsyncDatabase._readers = ThreadPoolExecutor(
+                max_workers=DATABASE_READER_THREADS,
+                thread_name_prefix='db-reader'
+            )
+        if AsyncDatabase._write_queue is None:
+            # Импорт здесь, чтобы избежать циклического импорта
+            from write_behind import WriteBehindQueue
+            AsyncDatabase._write_queue = WriteBehindQueue(
+                self,
+                WRITE_BEHIND_FLUSH_INTERVAL_MS / 1000,
+                WRITE_BEHIND_MAX_BATCH,
+                WRITE_BEHIND_MAX_PENDING
+            )
+    
+    @property
+    def write_queue(self):
+        """Общая очередь отложенной записи"""
+        return AsyncDatabase._write_queue
+    
+    async def run_write(self, method, *args):
+        """Выполнить метод Database в потоке-писателе"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(method, *args))
+    
+    async def run_read(self, method, *args):
+        """Выполнить читающий метод Database в пуле читателей"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, functools.partial(method, *args))
+    
+    async def run_read_after_writes(self, method, *args):
+        """Выполнить чтение, дождавшись записи уже поставленных в очередь вставок"""
+        await self.write_queue.sync()
+        return await self.run_read(method, *args)
+    
+    @classmethod
+    async def close(cls):
+        """Записать накопленные вставки, дождаться запросов и остановить потоки"""
+        if cls._write_queue is not None:
+            await cls._write_queue.stop()
+            cls._write_queue = None
+        cls.shutdown()
+    
+    @classmethod
+    def shutdown(cls):
+        """Дождаться завершения запросов и остановить потоки"""
+        for executor in (cls._writer, cls._readers):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        cls._writer = None
+        cls._readers = None
+    
+    async def add_user(self, user_id, username=None, first_name=None):
+        """Добавить пользователя в базу данных"""
+        return await self.run_write(self.database.add_user, user_id, username, first_name)
+    
+    async def save_dialogue(self, user_id, messages, durable=False):
+        """Сохранить диалог пользователя (через очередь отложенной записи).
+        
+        С durable=True ждёт, пока строка будет закоммичена.
+        """
+        messages_json = json.dumps(messages, ensure_ascii=False)
+        await self.write_queue.put(Database.INSERT_DIALOGUE, (user_id, messages_json), durable)
+    
+    async def save_vocabulary(self, user_id, topic, words, durable=False):
+        """Сохранить слова по теме для пользователя (через очередь отложенной записи)"""
+        words_json = json.dumps(words, ensure_ascii=False)
+        statements = [(Database.INSERT_VOCABULARY, (user_id, topic, words_json, len(words)))]
+        statements += Database.word_statements(user_id, words)
+        await self.write_queue.put_many(statements, durable)
+    
+    async def get_user_vocabulary(self, user_id):
+        """Получить все сохраненные слова пользователя"""
+        return await self.run_read_after_writes(self.database.get_user_vocabulary, user_id)
+    
+    async def get_user_vocabulary_summary(self, user_id, limit, before=None):
+        """Получить темы пользователя без самих слов (постранично)"""
+        return await self.run_read_after_writes(self.database.get_user_vocabulary_summary, user_id, limit, before)
+    
+    async def get_learned_lemmas(self, user_id, lemmas):
+        """Получить те из лемм, которые пользователь уже изучил"""
+        return await self.run_read(self.database.get_learned_lemmas, user_id, lemmas)
+    
+    async def count_learned_words(self, user_id):
+        """Получить число различных слов, изученных пользователем"""
+        return await self.run_read_after_writes(self.database.count_learned_words, user_id)
+    
+    async def get_due_words(self, user_id, limit):
+        """Получить карточки, которые пора повторить"""
+        return await self.run_read_after_writes(self.database.get_due_words, user_id, limit)
+    
+    async def get_next_due_at(self, user_id):
+        """Получить дату ближайшего повторения (или None)"""
+        return await self.run_read(self.database.get_next_due_at, user_id)
+    
+    async def save_review(self, user_id, word_id, grade, durable=False):
+        """Сохранить оценку повторения (применяется пачкой через очередь отложенной записи)"""
+        review = {
+            'user_id': user_id,
+            'word_id': word_id,
+            'grade': grade,
+            'reviewed_at': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        }
+        await self.write_queue.put(Database.REVIEW_USER_WORD, review, durable)
+    
+    async def search_user_words(self, user_id, text, limit):
+        """Найти изученные пользователем слова (полнотекстовый поиск)"""
+        return await self.run_read_after_writes(self.database.search_user_words, user_id, text, limit)
+    
+    async def get_user_sessions(self, user_id):
+        """Получить все состояния пользователя"""
+        return await self.run_read(self.database.get_user_sessions, user_id)
+    
+    async def save_user_sessions(self, user_id, writes, deletes, touches, touched_at):
+        """Записать состояния пользователя (возвращает конфликтующие namespace)"""
+        return await self.run_write(self.database.save_user_sessions, user_id, writes, deletes, touches, touched_at)
+    
+    async def acquire_session_lease(self, user_id, owner, now, expires_at):
+        """Взять аренду пользователя (True, если получилось)"""
+        return await self.run_write(self.database.acquire_session_lease, user_id, owner, now, expires_at)
+    
+    async def release_session_lease(self, user_id, owner):
+        """Вернуть аренду пользователя"""
+        await self.run_write(self.database.release_session_lease, user_id, owner)
+    
+    async def take_expired_sessions(self, namespace, min_touched_at):
+        """Удалить и вернуть истёкшие состояния"""
+        return await self.run_write(self.database.take_expired_sessions, namespace, min_touched_at)
+    
+    async def get_session_stats(self):
+        """Получить число состояний и их размер по namespace"""
+        return await self.run_read(self.database.get_session_stats)
+    
+    async def save_test_result(self, user_id, test_data, score, durable=False):
+        """Сохранить результат теста (через очередь отложенной записи)"""
+        test_json = json.dumps(test_data, ensure_ascii=False)
+        await self.write_queue.put(Database.INSERT_TEST_RESULT, (user_id, test_json, score), durable)
+    
+    async def get_user_test_history(self, user_id):
+        """Получить историю тестов пользователя"""
+        return await self.run_read_after_writes(self.database.get_user_test_history, user_id)
+    
+    async def save_pooled_test(self, tense_type, questions):
+        """Сохранить готовый тест в пул и вернуть его id"""
+        return await self.run_write(self.database.save_pooled_test, tense_type, questions)
+    
+    async def get_pooled_tests(self):
+        """Получить все тесты из пула (старые первыми)"""
+        return await self.run_read(self.database.get_pooled_tests)
+    
+    async def delete_pooled_test(self, test_id):
+        """Удалить выданный тест из пула"""
+        return await self.run_write(self.database.delete_pooled_test, test_id)
+    
+    async def save_questions(self, questions, tense_type):
+        """Сохранить вопросы в банк и проставить им id"""
+        return await self.run_write(self.database.save_questions, questions, tense_type)
+    
+    async def get_unseen_questions(self, user_id, tense_type, limit):
+        """Получить вопросы из банка, которые пользователь ещё не видел"""
+        return await self.run_read(self.database.get_unseen_questions, user_id, tense_type, limit)
+    
+    async def mark_questions_seen(self, user_id, question_ids):
+        """Отметить вопросы банка как показанные пользователю"""
+        return await self.run_write(self.database.mark_questions_seen, user_id, question_ids)
+    
+    async def get_cache_entry(self, namespace, key, min_created_at):
+        """Получить непросроченную запись кэша (обновляет время использования)"""
+        return await self.run_write(self.database.get_cache_entry, namespace, key, min_created_at)
+    
+    async def set_cache_entry(self, namespace, key, value, latency, created_at, max_entries):
+        """Сохранить запись кэша"""
+        return await self.run_write(self.database.set_cache_entry, namespace, key, value, latency, created_at, max_entries)
@@ -1,15 +1,50 @@
+import asyncio
 from gemini_service import GeminiService
-from database import Database
+from database import AsyncDatabase
+from session_store import session_store
+from config import GRAMMAR_CHECK_TIMEOUT, DIALOGUE_REPLY_TIMEOUT
 
 
 class Dialogue:
     # Максимальное количество обменов репликами (пользователь + ИИ = 1 обмен)
     MAX_EXCHANGES = 10
+    # Реплика собеседника, если Gemini не ответил
+    FALLBACK_REPLY = "Sorry, I couldn't process that. Could you please repeat?"
     
     def __init__(self):
         self.gemini = GeminiService()
-        self.db = Database()
-        self.conversations = {}  # Храним истории диалогов для каждого пользователя
+        self.db = AsyncDatabase()
+        # Храним истории диалогов для каждого пользователя; брошенные диалоги сохраняются при вытеснении
+        self.conversations = session_store.namespace(
+            'dialogues',
+            on_evict=self.save_abandoned_dialogue,
+            dump=self.conversation_to_state,
+            load=self.conversation_from_state
+        )
+    
+    @staticmethod
+    def conversation_to_state(conversation):
+        """Диалог в JSON-совместимом виде (для общего хранилища состояний)"""
+        return {
+            'user_role': conversation['user_role'],
+            'ai_role': conversation['ai_role'],
+            'messages': [{'role': m['role'], 'content': m['content']} for m in conversation['messages']],
+            'exchange_count': conversation['exchange_count'],
+            'total_errors': conversation['total_errors'],
+            'errors_history': [str(mistake) for mistake in conversation['errors_history']]
+        }
+    
+    @staticmethod
+    def conversation_from_state(state):
+        """Восстановить диалог из состояния, полученного через conversation_to_state"""
+        return {
+            'user_role': state['user_role'],
+            'ai_role': state['ai_role'],
+            'messages': list(state['messages']),
+            'exchange_count': int(state['exchange_count']),
+            'total_errors': int(state['total_errors']),
+            'errors_history': list(state['errors_history'])
+        }
     
     def start_dialogue(self, user_id, user_role="buyer", ai_role="seller"):
         """Начать новый диалог
@@ -39,23 +74,13 @@ class Dialogue:
         
         return initial_message
     
-    def send_message(self, user_id, user_message):
-        """Отправить сообщение в диалог"""
-
+    def begin_exchange(self, user_id, user_message):
+        """Добавить сообщение пользователя в диалог и вернуть диалог"""
         if user_id not in self.conversations:
             # Если диалог не начат, начинаем его с дефолтными ролями
             self.start_dialogue(user_id)
         
         conversation = self.conversations[user_id]
-        ai_role = conversation['ai_role']
-        
-        # Проверяем грамматику сообщения пользователя
-        grammar_result = self.gemini.check_grammar(user_message)
-        
-        # Обновляем статистику ошибок
-        if grammar_result['errors_count'] > 0:
-            conversation['total_errors'] += grammar_result['errors_count']
-            conversation['errors_history'].extend(grammar_result['mistakes'])
         
         # Добавляем сообщение пользователя
         conversation['messages'].append({
@@ -65,20 +90,60 @@ class Dialogue:
         
         # Увеличиваем счётчик обменов
         conversation['exchange_count'] += 1
+        return conversation
+    
+    async def send_message_streaming(self, user_id, user_message, on_progress):
+        """Отправить сообщение в диалог, получая реплику собеседника потоком.
+        
+        on_progress(result) - корутина; вызывается на каждый новый фрагмент реплики
+        и когда готова проверка грамматики. В result те же ключи, что в итоговом
+        результате, но grammar_check равен None, пока проверка не завершилась.
+        Возвращает итоговый результат: реплику, проверку грамматики, номер обмена
+        и статистику, если диалог завершён.
+        """
+        conversation = self.begin_exchange(user_id, user_message)
+        progress = {
+            'response': "",
+            'grammar_check': None,
+            'current_exchange': conversation['exchange_count'],
+            'max_exchanges': self.MAX_EXCHANGES
+        }
         
-        # Проверяем, достигнут ли лимит
-        is_finished = conversation['exchange_count'] >= self.MAX_EXCHANGES
-        
-        # Получаем ответ от ИИ (ИИ играет свою роль ai_role)
-        response = self.gemini.continue_dialogue(
-            conversation['messages'],
-            user_message,
-            ai_role
+        async def read_reply():
+            async for chunk in self.gemini.stream_dialogue(conversation['messages'], user_message, conversation['ai_role']):
+                if chunk.startswith("GEMINI_ERROR:"):
+                    break
+                progress['response'] += chunk
+                await on_progress(progress)
+        
+        async def read_grammar():
+            try:
+                progress['grammar_check'] = await asyncio.wait_for(
+                    self.gemini.check_grammar(user_message),
+                    GRAMMAR_CHECK_TIMEOUT
+                )
+            except Exception as e:
+                progress['grammar_check'] = self._grammar_check_skipped(user_message, e)
+            await on_progress(progress)
+        
+        # Проверка грамматики и реплика собеседника идут параллельно; таймаут оставляет уже полученную часть реплики
+        await asyncio.gather(
+            asyncio.wait_for(read_reply(), DIALOGUE_REPLY_TIMEOUT),
+            read_grammar(),
+            return_exceptions=True
         )
         
-        # Проверяем на ошибку API
-        if response.startswith("GEMINI_ERROR:"):
-            response = "Sorry, I couldn't process that. Could you please repeat?"
+        response = progress['response'].strip() or self.FALLBACK_REPLY
+        return self.finish_exchange(user_id, conversation, progress['grammar_check'], response)
+    
+    def finish_exchange(self, user_id, conversation, grammar_result, response):
+        """Учесть проверку грамматики, добавить реплику собеседника и собрать результат"""
+        is_finished = conversation['exchange_count'] >= self.MAX_EXCHANGES
+        
+        # Обновляем статистику ошибок
+        if grammar_result['errors_count'] > 0:
+            conversation['total_errors'] += grammar_result['errors_count']
+            conversation['errors_history'].extend(grammar_result['mistakes'])
         
         # Добавляем ответ ИИ
         conversation['messages'].append({
@@ -101,6 +166,14 @@ class Dialogue:
         
         return result
     
+    def _grammar_check_skipped(self, user_message, error):
+        """Результат проверки грамматики, если Gemini не ответил вовремя"""
+        if isinstance(error, asyncio.TimeoutError):
+            reason = "GEMINI_ERROR: Превышено время ожидания проверки грамматики"
+        else:
+            reason = f"GEMINI_ERROR: {error}"
+        return self.gemini.unavailable_grammar_check(reason, user_message)
+    
     def get_statistics(self, user_id):
         """Получить статистику диалога"""
         if user_id not in self.conversations:
@@ -115,16 +188,21 @@ class Dialogue:
             'all_mistakes': conversation['errors_history'][-10:]  # Последние 10 ошибок
         }
     
-    def end_dialogue(self, user_id):
+    async def end_dialogue(self, user_id):
         """Завершить диалог и сохранить в БД"""
         if user_id in self.conversations:
             stats = self.get_statistics(user_id)
             messages = self.conversations[user_id]['messages']
-            self.db.save_dialogue(user_id, messages)
+            await self.db.save_dialogue(user_id, messages)
             del self.conversations[user_id]
             return stats
         return None
     
+    async def save_abandoned_dialogue(self, user_id, conversation):
+        """Сохранить в БД диалог, брошенный пользователем (вызывается при вытеснении)"""
+        if conversation['exchange_count'] > 0:
+            await self.db.save_dialogue(user_id, conversation['messages'])
+    
     def get_user_role(self, user_id):
         """Получить роль пользователя в диалоге"""
         if user_id in self.conversations:
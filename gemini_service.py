@@ -1,63 +1,425 @@
+import asyncio
+import json
+import random
+import re
+import time
 import google.generativeai as genai
-from config import GEMINI_API_KEY, GEMINI_MODEL
+from google.api_core import exceptions as google_exceptions
+from cache import PersistentCache
+from rate_limiter import RequestScheduler
+from resilience import CircuitBreaker, LatencyTracker
+from parse_stats import parse_stats
+from config import (
+    GEMINI_API_KEY,
+    GEMINI_MODEL,
+    GEMINI_MAX_CONCURRENT_REQUESTS,
+    GEMINI_REQUESTS_PER_MINUTE,
+    GEMINI_TOKENS_PER_MINUTE,
+    GEMINI_QUEUE_LIMIT,
+    GEMINI_ATTEMPT_TIMEOUT,
+    GEMINI_DEADLINE,
+    GEMINI_MAX_RETRIES,
+    GEMINI_RETRY_BASE_DELAY,
+    GEMINI_RETRY_MAX_DELAY,
+    GEMINI_HEDGE_REQUESTS,
+    GEMINI_BREAKER_FAILURES,
+    GEMINI_BREAKER_RESET_TIMEOUT,
+    GEMINI_STRUCTURED_OUTPUT,
+    GRAMMAR_CACHE_SIZE,
+    GRAMMAR_CACHE_PERSISTENT_SIZE,
+    GRAMMAR_CACHE_TTL,
+    GRAMMAR_CACHE_MAX_TEXT_LENGTH,
+    GRAMMAR_CHECK_TIMEOUT,
+    DIALOGUE_REPLY_TIMEOUT
+)
+
+# Временные ошибки, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    ConnectionError,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+)
 
 
 class GeminiService:
+    # Типы времён для тестов по грамматике
+    TENSE_DESCRIPTIONS = {
+        "all": "все времена английского языка",
+        "present": "Present Simple, Present Continuous, Present Perfect, Present Perfect Continuous",
+        "past": "Past Simple, Past Continuous, Past Perfect, Past Perfect Continuous",
+        "future": "Future Simple, Future Continuous, Future Perfect, Future Perfect Continuous"
+    }
+    
+    # Общий для всех экземпляров планировщик: квота RPM/TPM, приоритеты и число одновременных запросов
+    _scheduler = None
+    # Общий кэш результатов проверки грамматики
+    _grammar_cache = None
+    # Общий выключатель: при серии сбоев Gemini запросы отклоняются сразу
+    _circuit_breaker = None
+    # Задержки успешных запросов по классам (для дублирования медленных запросов)
+    _latency_trackers = {}
+    # Классы, для которых допускается дублирование медленного запроса
+    HEDGED_PRIORITIES = ('dialogue', 'grammar')
+    # Параметры генерации для всех запросов
+    GENERATION_CONFIG = {
+        "temperature": 0.7,
+        "top_p": 0.8,
+        "top_k": 40,
+        "max_output_tokens": 2048,
+    }
+    
+    # Просить ли ответы в виде JSON по схеме (см. *_SCHEMA); текстовые парсеры остаются запасными
+    structured_output = GEMINI_STRUCTURED_OUTPUT
+    
+    # Схемы структурированных ответов
+    QUESTIONS_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "questions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "question": {"type": "string"},
+                        "options": {
+                            "type": "object",
+                            "properties": {letter: {"type": "string"} for letter in "abcd"},
+                            "required": list("abcd")
+                        },
+                        "difficulty": {"type": "string", "enum": ["easy", "medium", "hard"]},
+                        "correct_answer": {"type": "string", "enum": list("abcd")},
+                        "explanation": {"type": "string"}
+                    },
+                    "required": ["question", "options", "difficulty", "correct_answer", "explanation"]
+                }
+            }
+        },
+        "required": ["questions"]
+    }
+    VOCABULARY_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "words": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        field: {"type": "string"}
+                        for field in ("word", "transcription", "translation", "example_en", "example_ru")
+                    },
+                    "required": ["word", "transcription", "translation", "example_en", "example_ru"]
+                }
+            }
+        },
+        "required": ["words"]
+    }
+    GRAMMAR_CHECK_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "errors_found": {"type": "integer"},
+            "corrected": {"type": "string"},
+            "mistakes": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "original": {"type": "string"},
+                        "correct": {"type": "string"},
+                        "explanation": {"type": "string"}
+                    },
+                    "required": ["original", "correct", "explanation"]
+                }
+            }
+        },
+        "required": ["errors_found", "corrected", "mistakes"]
+    }
+    
     def __init__(self):
         genai.configure(api_key=GEMINI_API_KEY)
         self.model = genai.GenerativeModel(GEMINI_MODEL)
     
-    def generate_text(self, prompt, system_instruction=None):
-        """Генерировать текст с помощью Gemini"""
-        try:
+    @classmethod
+    def get_scheduler(cls):
+        """Получить общий планировщик запросов"""
+        if cls._scheduler is None:
+            cls._scheduler = RequestScheduler(
+                GEMINI_REQUESTS_PER_MINUTE,
+                GEMINI_TOKENS_PER_MINUTE,
+                GEMINI_MAX_CONCURRENT_REQUESTS,
+                GEMINI_QUEUE_LIMIT
+            )
+        return cls._scheduler
+    
+    @classmethod
+    def get_circuit_breaker(cls):
+        """Получить общий выключатель"""
+        if cls._circuit_breaker is None:
+            cls._circuit_breaker = CircuitBreaker(GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET_TIMEOUT)
+        return cls._circuit_breaker
+    
+    @classmethod
+    def get_latency_tracker(cls, priority):
+        """Получить окно задержек для класса запросов"""
+        if priority not in cls._latency_trackers:
+            cls._latency_trackers[priority] = LatencyTracker()
+        return cls._latency_trackers[priority]
+    
+    @classmethod
+    def is_available(cls):
+        """Gemini считается доступным, пока выключатель не разомкнут"""
+        return not cls.get_circuit_breaker().is_open()
+    
+    @classmethod
+    def get_grammar_cache(cls):
+        """Получить общий кэш проверки грамматики"""
+        if cls._grammar_cache is None:
+            cls._grammar_cache = PersistentCache(
+                'grammar',
+                GRAMMAR_CACHE_SIZE,
+                GRAMMAR_CACHE_TTL,
+                GRAMMAR_CACHE_PERSISTENT_SIZE
+            )
+        return cls._grammar_cache
+    
+    @staticmethod
+    def normalize_text_for_grammar(text):
+        """Нормализовать текст для ключа кэша.
+        
+        Регистр и пунктуация не учитываются - так же, как в правилах промпта check_grammar.
+        """
+        text = re.sub(r"[^\w\s]", "", text.lower())
+        return re.sub(r'\s+', ' ', text).strip()
+    
+    @classmethod
+    def is_idle(cls):
+        """Проверить, что сейчас нет запросов к Gemini"""
+        return cls.get_scheduler().is_idle()
+    
+    @staticmethod
+    def estimate_tokens(text):
+        """Грубая оценка числа токенов (около 4 символов на токен)"""
+        return len(text) // 4 + 1
+    
+    async def generate_text(self, prompt, system_instruction=None, priority='test', response_schema=None,
+                            timeout=GEMINI_DEADLINE):
+        """Генерировать текст с помощью Gemini (не блокирует event loop).
+        
+        priority - класс запроса для планировщика: dialogue, grammar, vocabulary, test или pool.
+        response_schema - схема JSON-ответа (структурированный режим).
+        Временные ошибки повторяются с экспоненциальной задержкой в пределах timeout секунд
+        (срок вызывающего, по умолчанию GEMINI_DEADLINE); пока выключатель разомкнут,
+        запрос сразу завершается ошибкой.
+        """
+        generation_config = self.GENERATION_CONFIG
+        if response_schema is not None:
             generation_config = {
-                "temperature": 0.7,
-                "top_p": 0.8,
-                "top_k": 40,
-                "max_output_tokens": 2048,
+                **generation_config,
+                "response_mime_type": "application/json",
+                "response_schema": response_schema
             }
+        
+        # Если есть системная инструкция, добавляем её в начало промпта
+        if system_instruction:
+            full_prompt = f"{system_instruction}\n\n{prompt}"
+        else:
+            full_prompt = prompt
+        
+        breaker = self.get_circuit_breaker()
+        if not breaker.allow_request():
+            return "GEMINI_ERROR: Gemini временно недоступен, попробуйте позже"
+        
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                response = await self.request_with_hedge(full_prompt, generation_config, priority, remaining)
+                breaker.record_success()
+                break
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                delay = random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** attempt))
+                attempt += 1
+                if attempt > GEMINI_MAX_RETRIES or breaker.is_open() or time.monotonic() + delay >= deadline:
+                    return f"GEMINI_ERROR: {str(e) or type(e).__name__}"
+                await asyncio.sleep(delay)
+            except Exception as e:
+                # Ошибка самого запроса (неверные параметры, переполненная очередь) - не повторяем.
+                # Это не сбой Gemini: выключатель не размыкается, только освобождается пробный запрос
+                breaker.release_probe()
+                return f"GEMINI_ERROR: {str(e)}"
+        
+        # Проверяем, есть ли текст в ответе
+        if response.parts:
+            return response.text
+        else:
+            # Если ответ пустой, возвращаем информативную ошибку
+            finish_reason = getattr(response.candidates[0], 'finish_reason', None) if response.candidates else None
+            return f"GEMINI_ERROR: Пустой ответ от API. Причина: {finish_reason}"
+    
+    async def request_with_hedge(self, full_prompt, generation_config, priority, timeout):
+        """Выполнить запрос; если он дольше обычного (p95), параллельно отправить второй.
+        
+        Возвращается первый успешный ответ, второй запрос отменяется.
+        Дублирование включается GEMINI_HEDGE_REQUESTS и только для интерактивных классов.
+        """
+        hedge_delay = None
+        if GEMINI_HEDGE_REQUESTS and priority in self.HEDGED_PRIORITIES:
+            hedge_delay = self.get_latency_tracker(priority).percentile(95)
+        
+        started = time.monotonic()
+        tasks = {asyncio.ensure_future(self.request_once(full_prompt, generation_config, priority, timeout))}
+        try:
+            if hedge_delay is not None and hedge_delay < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                if not done:
+                    tasks.add(asyncio.ensure_future(
+                        self.request_once(full_prompt, generation_config, priority, timeout - hedge_delay)
+                    ))
             
-            # Если есть системная инструкция, добавляем её в начало промпта
-            if system_instruction:
-                full_prompt = f"{system_instruction}\n\n{prompt}"
+            while True:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.get_latency_tracker(priority).record(time.monotonic() - started)
+                        return task.result()
+                if not tasks:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    async def request_once(self, full_prompt, generation_config, priority, timeout):
+        """Один запрос к Gemini через общий планировщик"""
+        # Резервируем квоту с запасом на весь ответ, неизрасходованное вернём после ответа
+        scheduler = self.get_scheduler()
+        reserved_tokens = self.estimate_tokens(full_prompt) + generation_config["max_output_tokens"]
+        used_tokens = reserved_tokens
+        await scheduler.acquire(priority, reserved_tokens)
+        try:
+            response = await asyncio.wait_for(
+                self.model.generate_content_async(
+                    full_prompt,
+                    generation_config=generation_config
+                ),
+                min(GEMINI_ATTEMPT_TIMEOUT, timeout)
+            )
+            usage = getattr(response, 'usage_metadata', None)
+            if usage is not None:
+                used_tokens = usage.total_token_count
             else:
-                full_prompt = prompt
-            
-            response = self.model.generate_content(
-                full_prompt,
-                generation_config=generation_config
+                used_tokens = self.estimate_tokens(full_prompt)
+                if response.parts:
+                    used_tokens += self.estimate_tokens(response.text)
+            return response
+        finally:
+            scheduler.release(reserved_tokens, used_tokens)
+    
+    async def stream_text(self, prompt, priority='test', timeout=GEMINI_DEADLINE):
+        """Генерировать текст потоком: асинхронный генератор фрагментов ответа.
+        
+        Ошибка передаётся последним фрагментом "GEMINI_ERROR: ...". Временные ошибки
+        повторяются, только пока не получено ни одного фрагмента и не истёк timeout.
+        """
+        breaker = self.get_circuit_breaker()
+        if not breaker.allow_request():
+            yield "GEMINI_ERROR: Gemini временно недоступен, попробуйте позже"
+            return
+        
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while True:
+            received = False
+            try:
+                async for chunk in self.stream_once(prompt, self.GENERATION_CONFIG, priority, deadline):
+                    received = True
+                    yield chunk
+                breaker.record_success()
+                return
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                delay = random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** attempt))
+                attempt += 1
+                if received or attempt > GEMINI_MAX_RETRIES or breaker.is_open() or time.monotonic() + delay >= deadline:
+                    yield f"GEMINI_ERROR: {str(e) or type(e).__name__}"
+                    return
+                await asyncio.sleep(delay)
+            except Exception as e:
+                breaker.release_probe()
+                yield f"GEMINI_ERROR: {str(e)}"
+                return
+    
+    async def stream_once(self, full_prompt, generation_config, priority, deadline):
+        """Один потоковый запрос к Gemini через общий планировщик"""
+        scheduler = self.get_scheduler()
+        reserved_tokens = self.estimate_tokens(full_prompt) + generation_config["max_output_tokens"]
+        used_tokens = reserved_tokens
+        await scheduler.acquire(priority, reserved_tokens)
+        try:
+            response = await asyncio.wait_for(
+                self.model.generate_content_async(
+                    full_prompt,
+                    generation_config=generation_config,
+                    stream=True
+                ),
+                min(GEMINI_ATTEMPT_TIMEOUT, deadline - time.monotonic())
             )
             
-            # Проверяем, есть ли текст в ответе
-            if response.parts:
-                return response.text
-            else:
-                # Если ответ пустой, возвращаем информативную ошибку
-                finish_reason = getattr(response.candidates[0], 'finish_reason', None) if response.candidates else None
-                return f"GEMINI_ERROR: Пустой ответ от API. Причина: {finish_reason}"
-                
-        except Exception as e:
-            return f"GEMINI_ERROR: {str(e)}"
-    
-    def create_grammar_test(self, tense_type="all"):
-        """Создать тест по временам английского языка"""
-        
-        tense_descriptions = {
-            "all": "все времена английского языка",
-            "present": "Present Simple, Present Continuous, Present Perfect, Present Perfect Continuous",
-            "past": "Past Simple, Past Continuous, Past Perfect, Past Perfect Continuous",
-            "future": "Future Simple, Future Continuous, Future Perfect, Future Perfect Continuous"
-        }
+            # Таймаут на каждый фрагмент (в пределах общего срока): зависший поток не держит вызывающего бесконечно
+            chunks = response.__aiter__()
+            received_length = 0
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        chunks.__anext__(),
+                        min(GEMINI_ATTEMPT_TIMEOUT, deadline - time.monotonic())
+                    )
+                except StopAsyncIteration:
+                    break
+                if chunk.parts:
+                    received_length += len(chunk.text)
+                    yield chunk.text
+            used_tokens = self.estimate_tokens(full_prompt) + received_length // 4
+        finally:
+            scheduler.release(reserved_tokens, used_tokens)
+    
+    def grammar_test_prompt(self, tense_type="all", structured=False, count=10, existing=None):
+        """Промпт для генерации теста по временам английского языка.
+        
+        existing - тексты уже полученных вопросов, которые нельзя повторять
+        (при догенерации недостающих вопросов).
+        """
+        
+        tense_desc = self.TENSE_DESCRIPTIONS.get(tense_type, "все времена английского языка")
         
-        tense_desc = tense_descriptions.get(tense_type, "все времена английского языка")
+        existing_text = ""
+        if existing:
+            existing_list = "\n".join(f"- {question}" for question in existing)
+            existing_text = f"\n\nНе повторяй эти вопросы, они уже есть в тесте:\n{existing_list}"
+        
+        if structured:
+            return f"""Создай тест по английской грамматике на тему: {tense_desc}.
+
+Требования:
+1. Тест должен содержать {count} вопросов
+2. Каждый вопрос должен иметь 4 варианта ответа (a, b, c, d)
+3. Только один вариант ответа правильный
+4. Вопросы должны быть разного уровня сложности (difficulty: easy, medium или hard)
+5. В explanation - объяснение на русском, почему ответ правильный{existing_text}"""
         
         prompt = f"""Создай тест по английской грамматике на тему: {tense_desc}.
 
 Требования:
-1. Тест должен содержать 10 вопросов
+1. Тест должен содержать {count} вопросов
 2. Каждый вопрос должен иметь 4 варианта ответа (a, b, c, d)
 3. Только один вариант ответа правильный
-4. Вопросы должны быть разного уровня сложности
+4. Вопросы должны быть разного уровня сложности{existing_text}
 
 Формат вывода - используй ТОЧНО такой текстовый формат для КАЖДОГО вопроса:
 
@@ -67,19 +429,53 @@ a) первый вариант
 b) второй вариант  
 c) третий вариант
 d) четвертый вариант
+СЛОЖНОСТЬ: easy, medium или hard
 ОТВЕТ: a
 ОБЪЯСНЕНИЕ: объяснение почему этот ответ правильный
 
 ВОПРОС 2:
-...и так далее для всех 10 вопросов.
+...и так далее для всех {count} вопросов.
 
 Начни прямо с "ВОПРОС 1:" без вступления."""
         
-        return self.generate_text(prompt)
+        return prompt
+    
+    async def create_grammar_test(self, tense_type="all", priority='test', count=10, existing=None):
+        """Создать тест по временам английского языка (JSON в структурированном режиме)"""
+        if self.structured_output:
+            return await self.generate_text(
+                self.grammar_test_prompt(tense_type, structured=True, count=count, existing=existing),
+                priority=priority,
+                response_schema=self.QUESTIONS_SCHEMA
+            )
+        return await self.generate_text(
+            self.grammar_test_prompt(tense_type, count=count, existing=existing),
+            priority=priority
+        )
+    
+    def stream_grammar_test(self, tense_type="all"):
+        """Создать тест потоком: асинхронный генератор фрагментов ответа.
+        
+        Поток всегда в текстовом формате (его разбирает QuestionStreamParser по блокам);
+        в режиме структурированных ответов тест создаётся целиком через create_grammar_test.
+        """
+        return self.stream_text(self.grammar_test_prompt(tense_type), priority='test')
     
-    def generate_vocabulary(self, topic, number_of_words=10):
+    async def generate_vocabulary(self, topic, number_of_words=10, exclude_words=None):
         """Сгенерировать слова для изучения по теме"""
         
+        # Слова, которые пользователь уже знает, просим не повторять
+        exclude_text = ""
+        if exclude_words:
+            exclude_text = f"\nНе используй эти слова, пользователь их уже изучил: {', '.join(exclude_words)}.\n"
+        
+        if self.structured_output:
+            prompt = f"""Создай список из {number_of_words} английских слов для изучения по теме: "{topic}".
+Для каждого слова укажи транскрипцию в квадратных скобках, перевод на русский
+и короткий пример на английском (example_en) с переводом (example_ru).
+{exclude_text}"""
+            return await self.generate_text(prompt, priority='vocabulary', response_schema=self.VOCABULARY_SCHEMA)
+        
         prompt = f"""Создай список из {number_of_words} английских слов для изучения по теме: "{topic}".
 
 Для КАЖДОГО слова используй ТОЧНО такой текстовый формат:
@@ -99,13 +495,57 @@ d) четвертый вариант
 Пример RU: Бананы желтые и сладкие.
 
 ...и так далее для всех {number_of_words} слов.
-
+{exclude_text}
 Важно: начни сразу со "СЛОВО 1:" без вступления. Тема: {topic}"""
         
-        return self.generate_text(prompt)
+        return await self.generate_text(prompt, priority='vocabulary')
+    
+    async def check_grammar(self, user_text):
+        """Проверить грамматику текста пользователя (с кэшированием частых фраз)"""
+        cache_key = self.normalize_text_for_grammar(user_text)
+        
+        if not cache_key or len(cache_key) > GRAMMAR_CACHE_MAX_TEXT_LENGTH:
+            return await self.check_grammar_uncached(user_text)
+        
+        # В кэше только поля, не зависящие от написания текста: число ошибок и их список.
+        # Исправленный текст относится к тексту того, кто сделал запрос, и в кэш не попадает
+        loaded = {}
+        
+        async def load():
+            result = await self.check_grammar_uncached(user_text)
+            loaded['result'] = result
+            return not result.get('unavailable'), self._grammar_cache_value(result)
+        
+        _, value = await self.get_grammar_cache().get_or_load(cache_key, load)
+        if 'result' in loaded:
+            return loaded['result']
+        return self._grammar_check_from_cache(value, user_text)
+    
+    @staticmethod
+    def _grammar_cache_value(result):
+        """Часть результата проверки, которую можно отдавать для других написаний того же текста"""
+        value = {'errors_count': result['errors_count'], 'mistakes': result['mistakes']}
+        if result.get('unavailable'):
+            value['unavailable'] = True
+        return value
+    
+    @staticmethod
+    def _grammar_check_from_cache(value, user_text):
+        """Собрать результат проверки для user_text из закэшированных полей (новый словарь на каждый вызов)"""
+        result = {
+            'errors_count': value['errors_count'],
+            # Исправленный вариант есть только у текста, который проверялся; без ошибок это сам текст
+            'corrected_text': user_text if value['errors_count'] == 0 else None,
+            'mistakes': list(value['mistakes'])
+        }
+        if value.get('unavailable'):
+            result['unavailable'] = True
+        return result
     
-    def check_grammar(self, user_text):
+    async def check_grammar_uncached(self, user_text):
         """Проверить грамматику текста пользователя и вернуть исправления"""
+        if self.structured_output:
+            return await self.check_grammar_structured(user_text)
         
         prompt = f"""Analyze the following English text for grammar, spelling, and vocabulary errors.
 
@@ -143,21 +583,85 @@ MISTAKES:
 
 Now analyze the text."""
         
-        response = self.generate_text(prompt)
+        response = await self.generate_text(prompt, priority='grammar', timeout=GRAMMAR_CHECK_TIMEOUT)
         
         if response.startswith("GEMINI_ERROR:"):
-            return {
-                'errors_count': 0,
-                'corrected_text': user_text,
-                'mistakes': [],
-                'raw_response': response
-            }
+            return self.unavailable_grammar_check(response, user_text)
         
         # Парсим ответ
-        return self._parse_grammar_check(response, user_text)
+        result, parsed = self._parse_grammar_check(response, user_text)
+        parse_stats.record('grammar', 'text', 'ok' if parsed else 'failed')
+        return result
+    
+    async def check_grammar_structured(self, user_text):
+        """Проверить грамматику, получив ответ в виде JSON по GRAMMAR_CHECK_SCHEMA"""
+        prompt = f"""Analyze the following English text for grammar, spelling, and vocabulary errors.
+
+Text to analyze: "{user_text}"
+
+IMPORTANT RULES:
+1. DO NOT count punctuation or capitalization errors
+2. ONLY count real grammar mistakes, spelling errors, and wrong word usage
+3. errors_found - number of REAL errors (0 if none), corrected - corrected text
+   (the original text if there are no errors), mistakes - one item per error
+   with the explanation in Russian"""
+        
+        response = await self.generate_text(
+            prompt,
+            priority='grammar',
+            response_schema=self.GRAMMAR_CHECK_SCHEMA,
+            timeout=GRAMMAR_CHECK_TIMEOUT
+        )
+        
+        if response.startswith("GEMINI_ERROR:"):
+            return self.unavailable_grammar_check(response, user_text)
+        
+        result = self._decode_grammar_check(response, user_text)
+        if result is not None:
+            parse_stats.record('grammar', 'json', 'ok')
+            return result
+        
+        # Модель ответила не по схеме - пробуем текстовый парсер
+        result, parsed = self._parse_grammar_check(response, user_text)
+        parse_stats.record('grammar', 'json', 'fallback' if parsed else 'failed')
+        return result
+    
+    @staticmethod
+    def unavailable_grammar_check(response, user_text):
+        """Результат проверки, если Gemini вернул ошибку или не ответил (response - текст ошибки)"""
+        return {
+            'errors_count': 0,
+            'corrected_text': user_text,
+            'mistakes': [],
+            'raw_response': response,
+            'unavailable': True
+        }
+    
+    def _decode_grammar_check(self, response, original_text):
+        """Разобрать и проверить JSON-ответ проверки грамматики (None, если он не по схеме)"""
+        try:
+            data = json.loads(response)
+            errors_count = int(data['errors_found'])
+            corrected = data['corrected']
+            mistakes = [
+                f"- Original: {m['original']} -> Correct: {m['correct']} | Explanation: {m['explanation']}"
+                for m in data['mistakes']
+            ]
+        except (ValueError, KeyError, TypeError):
+            return None
+        
+        if errors_count < 0 or not isinstance(corrected, str):
+            return None
+        
+        return {
+            'errors_count': errors_count,
+            'corrected_text': corrected.strip() or original_text,
+            'mistakes': mistakes,
+            'raw_response': response
+        }
     
     def _parse_grammar_check(self, response, original_text):
-        """Парсить ответ проверки грамматики"""
+        """Парсить ответ проверки грамматики: вернуть (результат, найдено ли число ошибок ERRORS_FOUND)"""
         result = {
             'errors_count': 0,
             'corrected_text': original_text,
@@ -165,6 +669,7 @@ Now analyze the text."""
             'raw_response': response
         }
         
+        parsed = False
         lines = response.strip().split('\n')
         
         for line in lines:
@@ -175,6 +680,7 @@ Now analyze the text."""
                 try:
                     count = line.split(':')[1].strip()
                     result['errors_count'] = int(count)
+                    parsed = True
                 except (ValueError, IndexError):
                     pass
             
@@ -190,10 +696,10 @@ Now analyze the text."""
             elif line.startswith('-') and 'No mistakes' not in line and line != '-':
                 result['mistakes'].append(line)
         
-        return result
+        return result, parsed
     
-    def continue_dialogue(self, conversation_history, user_message, ai_role="seller"):
-        """Продолжить диалог в роли продавца или покупателя"""
+    def dialogue_prompt(self, conversation_history, user_message, ai_role="seller"):
+        """Промпт для продолжения диалога в роли продавца или покупателя"""
         
         if ai_role == "seller":
             system_instruction = """You are a friendly shop assistant/seller in a store.
@@ -237,4 +743,14 @@ Continue the following store dialogue:
 
 Your response as {role_label_ai} (in English only):"""
         
-        return self.generate_text(full_prompt)
\ No newline at end of file
+        return full_prompt
+    
+    async def continue_dialogue(self, conversation_history, user_message, ai_role="seller"):
+        """Продолжить диалог в роли продавца или покупателя"""
+        prompt = self.dialogue_prompt(conversation_history, user_message, ai_role)
+        return await self.generate_text(prompt, priority='dialogue', timeout=DIALOGUE_REPLY_TIMEOUT)
+    
+    def stream_dialogue(self, conversation_history, user_message, ai_role="seller"):
+        """Продолжить диалог потоком: асинхронный генератор фрагментов реплики"""
+        prompt = self.dialogue_prompt(conversation_history, user_message, ai_role)
+        return self.stream_text(prompt, priority='dialogue', timeout=DIALOGUE_REPLY_TIMEOUT)
\ No newline at end of file
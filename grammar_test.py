@@ -1,15 +1,114 @@
+import asyncio
+import json
+import logging
 import re
 from gemini_service import GeminiService
+from database import AsyncDatabase, Database
+from parse_stats import parse_stats
+
+logger = logging.getLogger(__name__)
+
+
+class QuestionStreamParser:
+    """Инкрементальный парсер потокового ответа с вопросами теста.
+    
+    Блок "ВОПРОС N:" считается готовым, как только полностью получена строка
+    ОБЪЯСНЕНИЕ (или начался следующий вопрос), и сразу разбирается parse_block.
+    """
+    
+    HEADER = re.compile(r'ВОПРОС\s*\d+\s*:', re.IGNORECASE)
+    EXPLANATION_LINE = re.compile(r'^[ \t]*ОБЪЯСНЕНИЕ\s*:.*\n', re.IGNORECASE | re.MULTILINE)
+    
+    def __init__(self, parse_block):
+        self.parse_block = parse_block
+        self.buffer = ""
+    
+    def feed(self, text):
+        """Добавить фрагмент ответа и вернуть вопросы, которые стали готовы"""
+        self.buffer += text
+        questions = []
+        
+        while True:
+            header = self.HEADER.search(self.buffer)
+            if header is None:
+                break
+            
+            next_header = self.HEADER.search(self.buffer, header.end())
+            block_end = next_header.start() if next_header else len(self.buffer)
+            explanation = self.EXPLANATION_LINE.search(self.buffer, header.end(), block_end)
+            
+            if explanation:
+                block_end = explanation.end()
+            elif next_header is None:
+                break  # Блок ещё не дописан
+            
+            question = self.parse_block(self.buffer[header.end():block_end])
+            if question:
+                questions.append(question)
+            self.buffer = self.buffer[block_end:]
+        
+        return questions
+    
+    def finish(self):
+        """Разобрать последний блок, когда ответ получен целиком"""
+        questions = []
+        header = self.HEADER.search(self.buffer)
+        if header:
+            question = self.parse_block(self.buffer[header.end():])
+            if question:
+                questions.append(question)
+        self.buffer = ""
+        return questions
 
 
 class GrammarTest:
+    # Количество вопросов в тесте из банка
+    QUESTIONS_PER_TEST = 10
+    # Допустимые уровни сложности
+    DIFFICULTIES = ('easy', 'medium', 'hard')
+    # Сколько вопросов просим у Gemini (пока тест догенерируется, показываем это число)
+    QUESTIONS_PER_GENERATED_TEST = 10
+    # Меньше вопросов тест не бывает; потоковый тест начинается, когда готово столько вопросов
+    MIN_QUESTIONS_PER_TEST = 3
+    
+    # Шаблоны запасного парсера (fallback_parse), применяются к одной строке
+    FALLBACK_HEADER = re.compile(r'(?:ВОПРОС(?=[\s\d:]|$)\s*\d*\s*:?|\d+\s*[\.\)])\s*(.*)', re.IGNORECASE)
+    FALLBACK_OPTION = re.compile(r'\(?([a-d])\s*[\)\.]\s*(.+)', re.IGNORECASE)
+    FALLBACK_ANSWER = re.compile(
+        r'\W*(?:(?:правильный\s+)?ОТВЕТ|(?:correct\s+)?answer|correct)\W*([a-d])(?!\w)', re.IGNORECASE
+    )
+    FALLBACK_DIFFICULTY = re.compile(r'\W*(?:СЛОЖНОСТЬ|difficulty)\W*(easy|medium|hard)(?!\w)', re.IGNORECASE)
+    FALLBACK_EXPLANATION = re.compile(r'\W*(?:ОБЪЯСНЕНИЕ|explanation)\W*(.*)', re.IGNORECASE)
+    
     def __init__(self):
         self.gemini = GeminiService()
+        self.db = AsyncDatabase()
         self.current_test = None
         self.current_question_index = 0
         self.user_answers = []
+        self.generating = False  # вопросы ещё догенерируются в фоне (потоковое создание теста)
+        self.generation_task = None
+        self.questions_changed = asyncio.Condition()
+    
+    def to_state(self):
+        """Состояние теста в JSON-совместимом виде (для общего хранилища состояний)"""
+        return {
+            'current_test': self.current_test,
+            'current_question_index': self.current_question_index,
+            'user_answers': self.user_answers
+        }
     
-    def parse_test_response(self, response):
+    @classmethod
+    def from_state(cls, state):
+        """Восстановить тест из состояния, полученного через to_state"""
+        test = cls()
+        test.current_test = state['current_test']
+        test.current_question_index = state['current_question_index']
+        test.user_answers = state['user_answers']
+        return test
+    
+    @classmethod
+    def parse_test_response(cls, response):
         """Парсить текстовый ответ от Gemini и извлечь вопросы"""
         questions = []
         
@@ -21,7 +120,7 @@ class GrammarTest:
                 continue
             
             try:
-                question_data = self.parse_question_block(block)
+                question_data = cls.parse_question_block(block)
                 if question_data:
                     questions.append(question_data)
             except Exception:
@@ -29,7 +128,8 @@ class GrammarTest:
         
         return questions
     
-    def parse_question_block(self, block):
+    @classmethod
+    def parse_question_block(cls, block):
         """Парсить отдельный блок вопроса"""
         lines = block.strip().split('\n')
         
@@ -37,6 +137,7 @@ class GrammarTest:
         options = {}
         correct_answer = ""
         explanation = ""
+        difficulty = "medium"
         
         current_section = "question"
         
@@ -51,6 +152,13 @@ class GrammarTest:
                 options[option_match.group(1).lower()] = option_match.group(2).strip()
                 continue
             
+            # Проверяем уровень сложности
+            difficulty_match = re.match(r'^СЛОЖНОСТЬ\s*:\s*(\w+)', line, re.IGNORECASE)
+            if difficulty_match:
+                if difficulty_match.group(1).lower() in cls.DIFFICULTIES:
+                    difficulty = difficulty_match.group(1).lower()
+                continue
+            
             # Проверяем правильный ответ
             answer_match = re.match(r'^ОТВЕТ\s*:\s*([a-d])', line, re.IGNORECASE)
             if answer_match:
@@ -77,87 +185,324 @@ class GrammarTest:
                 "question": question_text.strip(),
                 "options": options,
                 "correct_answer": correct_answer,
-                "explanation": explanation.strip() if explanation else "Нет объяснения"
+                "explanation": explanation.strip() if explanation else "Нет объяснения",
+                "difficulty": difficulty
             }
         
         return None
     
-    def create_test(self, tense_type="all"):
-        """Создать новый тест"""
-        response = self.gemini.create_grammar_test(tense_type)
+    async def generate_questions(self, tense_type="all", priority='test'):
+        """Сгенерировать и распарсить вопросы теста, не начиная сам тест"""
+        response = await self.gemini.create_grammar_test(tense_type, priority)
         
         # Проверяем на ошибку API
         if response.startswith("GEMINI_ERROR:"):
             return False, response.replace("GEMINI_ERROR: ", "")
         
-        # Парсим текстовый ответ
-        questions = self.parse_test_response(response)
+        mode = 'json' if self.gemini.structured_output else 'text'
+        questions, outcome = self.parse_questions(response)
         
-        if questions and len(questions) >= 3:  # Минимум 3 вопроса для теста
-            self.current_test = {
-                "questions": questions,
-                "tense_type": tense_type
-            }
-            self.current_question_index = 0
-            self.user_answers = []
-            return True, f"Тест создан успешно! ({len(questions)} вопросов)"
-        else:
-            # Попробуем ещё раз с упрощенным парсингом
-            questions = self.fallback_parse(response)
-            if questions and len(questions) >= 3:
-                self.current_test = {
-                    "questions": questions,
-                    "tense_type": tense_type
+        if questions and len(questions) < self.QUESTIONS_PER_GENERATED_TEST:
+            # Часть вопросов не распозналась - догенерируем только недостающие
+            questions = questions + await self.fetch_missing_questions(questions, tense_type, priority)
+        
+        if questions and len(questions) >= self.MIN_QUESTIONS_PER_TEST:
+            parse_stats.record('test', mode, outcome)
+            # Складываем вопросы в банк (дубликаты отбрасываются по хэшу текста)
+            await self.db.save_questions(questions, tense_type)
+            return True, questions
+        
+        parse_stats.record('test', mode, 'failed')
+        return False, f"Не удалось создать тест. Попробуйте ещё раз. Ответ: {response[:300]}..."
+    
+    def parse_questions(self, response):
+        """Разобрать ответ Gemini с вопросами: вернуть (вопросы, ok или fallback).
+        
+        Пока вопросов меньше минимума теста, пробуем следующий парсер и берём его
+        результат, только если он нашёл больше. Сам минимум проверяется по итоговому
+        тесту (после догенерации), поэтому здесь можно вернуть и 1-2 вопроса.
+        """
+        parsers = [(self.parse_test_response, 'ok'), (self.fallback_parse, 'fallback')]
+        if self.gemini.structured_output:
+            # Текстовые парсеры - запасной вариант, если модель ответила не по схеме
+            parsers = [(self.decode_questions_json, 'ok'), (self.parse_test_response, 'fallback'), (self.fallback_parse, 'fallback')]
+        
+        questions, outcome = [], 'ok'
+        for parse, parser_outcome in parsers:
+            if len(questions) >= self.MIN_QUESTIONS_PER_TEST:
+                break
+            parsed = parse(response) or []
+            if len(parsed) > len(questions):
+                questions, outcome = parsed, parser_outcome
+        
+        return questions, outcome
+    
+    async def fetch_missing_questions(self, questions, tense_type, priority='test'):
+        """Попросить у Gemini только недостающие вопросы, передав уже полученные, чтобы не было повторов"""
+        missing = self.QUESTIONS_PER_GENERATED_TEST - len(questions)
+        response = await self.gemini.create_grammar_test(
+            tense_type, priority, count=missing, existing=[q['question'] for q in questions]
+        )
+        if response.startswith("GEMINI_ERROR:"):
+            parse_stats.record_repair('test', missing, 0)
+            return []
+        
+        extra, _ = self.parse_questions(response)
+        seen = {Database.question_hash(q) for q in questions}
+        added = []
+        for question in extra or []:
+            question_hash = Database.question_hash(question)
+            if question_hash not in seen and len(added) < missing:
+                added.append(question)
+                seen.add(question_hash)
+        
+        parse_stats.record_repair('test', missing, len(added))
+        return added
+    
+    @classmethod
+    def decode_questions_json(cls, response):
+        """Разобрать JSON-ответ по QUESTIONS_SCHEMA, отбросив вопросы, которые не проходят проверку"""
+        try:
+            items = json.loads(response)['questions']
+        except (ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(items, list):
+            return None
+        
+        questions = []
+        for item in items:
+            try:
+                options = {letter: item['options'][letter].strip() for letter in 'abcd'}
+                question = {
+                    "question": item['question'].strip(),
+                    "options": options,
+                    "correct_answer": item['correct_answer'].strip().lower(),
+                    "explanation": item.get('explanation', '').strip() or "Нет объяснения",
+                    "difficulty": item.get('difficulty', 'medium')
                 }
-                self.current_question_index = 0
-                self.user_answers = []
-                return True, f"Тест создан успешно! ({len(questions)} вопросов)"
+            except (KeyError, TypeError, AttributeError):
+                continue
             
-            return False, f"Не удалось создать тест. Попробуйте ещё раз. Ответ: {response[:300]}..."
+            if question['difficulty'] not in cls.DIFFICULTIES:
+                question['difficulty'] = 'medium'
+            if question['question'] and all(options.values()) and question['correct_answer'] in options:
+                questions.append(question)
+        
+        return questions
+    
+    def load_test(self, questions, tense_type="all"):
+        """Начать тест по готовому списку вопросов"""
+        self.current_test = {
+            "questions": questions,
+            "tense_type": tense_type
+        }
+        self.current_question_index = 0
+        self.user_answers = []
+        return True, f"Тест создан успешно! ({len(questions)} вопросов)"
+    
+    async def create_test_from_bank(self, user_id, tense_type="all"):
+        """Собрать тест из банка вопросов без обращения к Gemini"""
+        questions = await self.db.get_unseen_questions(user_id, tense_type, self.QUESTIONS_PER_TEST)
+        
+        if len(questions) < self.QUESTIONS_PER_TEST:
+            return False, "В банке недостаточно новых для вас вопросов"
+        
+        return self.load_test(questions, tense_type)
     
-    def fallback_parse(self, response):
-        """Запасной метод парсинга - более гибкий"""
+    async def mark_questions_seen(self, user_id):
+        """Отметить вопросы текущего теста как показанные пользователю"""
+        if not self.current_test:
+            return
+        question_ids = [q['id'] for q in self.current_test['questions'] if 'id' in q]
+        await self.db.mark_questions_seen(user_id, question_ids)
+    
+    def is_generating(self):
+        """Вопросы теста ещё догенерируются в фоне"""
+        return self.generating
+    
+    def cancel_generation(self):
+        """Остановить фоновую догенерацию вопросов (тест отменён или вытеснен)"""
+        if self.generation_task is not None and not self.generation_task.done():
+            self.generation_task.cancel()
+    
+    async def create_test_streaming(self, user_id, tense_type="all"):
+        """Создать тест потоком: вернуть управление, как только готовы первые MIN_QUESTIONS_PER_TEST вопросов.
+        
+        Остальные вопросы добавляются в тест по мере генерации; в конце они
+        сохраняются в банк и отмечаются как показанные пользователю. Если даже
+        после догенерации вопросов меньше минимума, тест не создаётся.
+        """
+        self.load_test([], tense_type)
+        self.generating = True
+        ready = asyncio.Event()
+        self.generation_task = asyncio.create_task(self.stream_questions(user_id, tense_type, ready))
+        
+        waiter = asyncio.ensure_future(ready.wait())
+        await asyncio.wait({self.generation_task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        if ready.is_set():
+            return True, "Тест создаётся, первые вопросы готовы"
+        
+        success, result = await self.generation_task
+        return False, result
+    
+    async def stream_questions(self, user_id, tense_type, ready):
+        """Фоновая задача: читать поток Gemini и добавлять готовые вопросы в тест"""
+        questions = self.current_test['questions']
+        parser = QuestionStreamParser(self.parse_question_block)
+        response = ""
+        
+        async def add(new_questions):
+            if not new_questions:
+                return
+            async with self.questions_changed:
+                questions.extend(new_questions)
+                self.questions_changed.notify_all()
+            if len(questions) >= self.MIN_QUESTIONS_PER_TEST:
+                ready.set()
+        
+        try:
+            async for chunk in self.gemini.stream_grammar_test(tense_type):
+                if chunk.startswith("GEMINI_ERROR:"):
+                    if not questions:
+                        return False, chunk.replace("GEMINI_ERROR: ", "")
+                    logger.warning("Поток теста прерван: %s", chunk[:100])
+                    break
+                response += chunk
+                await add(parser.feed(chunk))
+            await add(parser.finish())
+            outcome = 'ok'
+            
+            if not questions:
+                # Формат не распознался по блокам - пробуем запасной парсер на всём ответе
+                await add(self.fallback_parse(response))
+                outcome = 'fallback'
+            if questions and len(questions) < self.QUESTIONS_PER_GENERATED_TEST:
+                # Пользователь, возможно, уже отвечает на первые вопросы, недостающие допишем в конец теста
+                await add(await self.fetch_missing_questions(list(questions), tense_type))
+            
+            if len(questions) < self.MIN_QUESTIONS_PER_TEST:
+                # Тест так и не набрал минимум вопросов - пользователю он не показывался
+                parse_stats.record('test', 'stream', 'failed')
+                return False, f"Не удалось создать тест. Попробуйте ещё раз. Ответ: {response[:300]}..."
+            parse_stats.record('test', 'stream', outcome)
+            
+            await self.db.save_questions(questions, tense_type)
+            await self.mark_questions_seen(user_id)
+            return True, questions
+        except Exception as e:
+            logger.exception("Ошибка потоковой генерации теста")
+            return False, str(e)
+        finally:
+            async with self.questions_changed:
+                self.generating = False
+                self.questions_changed.notify_all()
+    
+    async def wait_for_question(self):
+        """Дождаться текущего вопроса, если он ещё генерируется"""
+        async with self.questions_changed:
+            await self.questions_changed.wait_for(
+                lambda: self.current_question_index < len(self.current_test['questions']) or not self.is_generating()
+            )
+    
+    async def create_test(self, tense_type="all"):
+        """Создать новый тест"""
+        success, result = await self.generate_questions(tense_type)
+        
+        if not success:
+            return False, result
+        
+        return self.load_test(result, tense_type)
+    
+    @classmethod
+    def fallback_parse(cls, response):
+        """Запасной метод парсинга - более гибкий.
+        
+        Один проход по строкам ответа: текст вопроса, варианты a-d подряд, затем
+        ответ, сложность и объяснение. К строке применяется не больше нескольких
+        заранее скомпилированных шаблонов без вложенных повторов, поэтому время
+        разбора линейно по длине ответа даже на испорченном выводе.
+        """
         questions = []
+        pending = []  # строки текста очередного вопроса
+        new_paragraph = False
+        current = None  # вопрос, у которого уже начались варианты
+        state = 'text'  # text, options (ждём b-d) или details (ответ и объяснение)
+        explaining = False  # объяснение может продолжаться на следующих строках того же абзаца
         
-        # Ищем любые паттерны вопросов с вариантами
-        # Паттерн: текст с вариантами a), b), c), d)
-        pattern = r'(.+?)\n\s*a\s*[\)\.]\s*(.+?)\n\s*b\s*[\)\.]\s*(.+?)\n\s*c\s*[\)\.]\s*(.+?)\n\s*d\s*[\)\.]\s*(.+?)(?:\n|$)'
-        
-        matches = re.findall(pattern, response, re.IGNORECASE | re.DOTALL)
-        
-        for i, match in enumerate(matches):
-            if len(match) >= 5:
-                question_text = match[0].strip()
-                # Убираем номер вопроса из текста
-                question_text = re.sub(r'^\d+[\.\)]\s*', '', question_text)
-                question_text = re.sub(r'^ВОПРОС\s*\d*\s*:?\s*', '', question_text, flags=re.IGNORECASE)
-                
-                options = {
-                    'a': match[1].strip(),
-                    'b': match[2].strip(),
-                    'c': match[3].strip(),
-                    'd': match[4].strip()
-                }
-                
-                # Ищем ответ после вариантов
-                answer_pattern = rf'{re.escape(match[4])}.*?(?:ОТВЕТ|Answer|Correct)\s*:?\s*([a-d])'
-                answer_match = re.search(answer_pattern, response, re.IGNORECASE | re.DOTALL)
-                correct_answer = answer_match.group(1).lower() if answer_match else 'a'
-                
-                # Ищем объяснение
-                explanation = "Нет объяснения"
-                expl_pattern = rf'{re.escape(match[4])}.*?(?:ОБЪЯСНЕНИЕ|Explanation)\s*:?\s*(.+?)(?:ВОПРОС|$)'
-                expl_match = re.search(expl_pattern, response, re.IGNORECASE | re.DOTALL)
-                if expl_match:
-                    explanation = expl_match.group(1).strip()[:200]
-                
-                questions.append({
-                    "question": question_text,
-                    "options": options,
-                    "correct_answer": correct_answer,
-                    "explanation": explanation
-                })
+        def add(question):
+            if question and question['question'] and len(question['options']) == 4:
+                question['explanation'] = question['explanation'][:200] or "Нет объяснения"
+                questions.append(question)
         
+        for line in response.splitlines():
+            line = line.strip()
+            if not line:
+                new_paragraph = True
+                continue
+            
+            # Заголовок "ВОПРОС N:" или "N." начинает новый вопрос
+            header = cls.FALLBACK_HEADER.match(line)
+            if header:
+                add(current)
+                current, state = None, 'text'
+                pending = [header.group(1)] if header.group(1) else []
+                new_paragraph = False
+                continue
+            
+            option = cls.FALLBACK_OPTION.match(line)
+            if option:
+                letter = option.group(1).lower()
+                if letter == 'a':
+                    add(current)
+                    current = {
+                        "question": " ".join(pending),
+                        "options": {'a': option.group(2).strip()},
+                        "correct_answer": 'a',
+                        "explanation": "",
+                        "difficulty": "medium"
+                    }
+                    pending, state = [], 'options'
+                    continue
+                if state == 'options' and letter == 'abcd'[len(current['options'])]:
+                    current['options'][letter] = option.group(2).strip()
+                    if letter == 'd':
+                        state, explaining = 'details', False
+                    continue
+            
+            if state == 'details':
+                answer = cls.FALLBACK_ANSWER.match(line)
+                if answer:
+                    current['correct_answer'] = answer.group(1).lower()
+                    explaining = False
+                    continue
+                difficulty = cls.FALLBACK_DIFFICULTY.match(line)
+                if difficulty:
+                    current['difficulty'] = difficulty.group(1).lower()
+                    explaining = False
+                    continue
+                explanation = cls.FALLBACK_EXPLANATION.match(line)
+                if explanation:
+                    current['explanation'] = explanation.group(1).strip()
+                    explaining = True
+                    continue
+                if explaining and not new_paragraph:
+                    # Продолжение объяснения; дальше 200 символов оно всё равно обрезается
+                    if len(current['explanation']) < 200:
+                        current['explanation'] = f"{current['explanation']} {line}".strip()
+                    continue
+                explaining = False
+            elif state == 'options':
+                # Варианты идут не подряд - это не вопрос
+                current, state = None, 'text'
+            
+            # Текст следующего вопроса: берём последний абзац перед вариантами
+            if new_paragraph:
+                pending = []
+            pending.append(line)
+            new_paragraph = False
+        
+        add(current)
         return questions
     
     def get_current_question(self):
@@ -169,9 +514,12 @@ class GrammarTest:
             return None
         
         question = self.current_test['questions'][self.current_question_index]
+        total = len(self.current_test['questions'])
+        if self.is_generating():
+            total = max(total, self.QUESTIONS_PER_GENERATED_TEST)
         return {
             'number': self.current_question_index + 1,
-            'total': len(self.current_test['questions']),
+            'total': total,
             'question': question['question'],
             'options': question['options'],
             'correct_answer': question.get('correct_answer'),
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from collections import deque
+from database import AsyncDatabase
+from gemini_service import GeminiService
+from grammar_test import GrammarTest
+from config import (
+    TEST_POOL_LOW_WATERMARK,
+    TEST_POOL_HIGH_WATERMARK,
+    TEST_POOL_REFILL_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+
+class GrammarTestPool:
+    """Пул заранее сгенерированных тестов для каждого типа времён.
+    
+    Тесты хранятся в БД (переживают перезапуск) и в памяти (deque на тип времён),
+    поэтому выдача теста - это popleft без обращения к Gemini. Фоновая задача
+    дозаполняет пул, когда Gemini простаивает.
+    """
+    
+    def __init__(self, low_watermark=TEST_POOL_LOW_WATERMARK,
+                 high_watermark=TEST_POOL_HIGH_WATERMARK,
+                 refill_interval=TEST_POOL_REFILL_INTERVAL):
+        self.db = AsyncDatabase()
+        self.low_watermark = low_watermark
+        self.high_watermark = max(high_watermark, low_watermark)
+        self.refill_interval = refill_interval
+        self.pools = {tense: deque() for tense in GeminiService.TENSE_DESCRIPTIONS}
+        self.stats = {'hits': 0, 'misses': 0, 'generated': 0, 'failed': 0}
+        self.refill_task = None
+        self.wakeup = asyncio.Event()
+    
+    async def load(self):
+        """Загрузить сохранённые в БД тесты"""
+        for test in await self.db.get_pooled_tests():
+            if test['tense_type'] in self.pools:
+                self.pools[test['tense_type']].append((test['id'], test['questions']))
+    
+    async def get_test(self, tense_type):
+        """Взять готовый тест из пула (или None, если пул пуст)"""
+        pool = self.pools.get(tense_type)
+        if not pool:
+            self.stats['misses'] += 1
+            self.wakeup.set()
+            return None
+        
+        test_id, questions = pool.popleft()
+        await self.db.delete_pooled_test(test_id)
+        self.stats['hits'] += 1
+        
+        if len(pool) < self.low_watermark:
+            self.wakeup.set()
+        
+        return questions
+    
+    async def put_test(self, tense_type, questions):
+        """Положить готовый тест в пул"""
+        test_id = await self.db.save_pooled_test(tense_type, questions)
+        self.pools[tense_type].append((test_id, questions))
+    
+    def get_stats(self):
+        """Получить глубину пула и счётчики попаданий/промахов"""
+        total = self.stats['hits'] + self.stats['misses']
+        return {
+            'depth': {tense: len(pool) for tense, pool in self.pools.items()},
+            'hits': self.stats['hits'],
+            'misses': self.stats['misses'],
+            'hit_ratio': round(self.stats['hits'] / total, 2) if total else 0.0,
+            'generated': self.stats['generated'],
+            'failed': self.stats['failed']
+        }
+    
+    async def refill_once(self):
+        """Дозаполнить пулы, опустившиеся ниже нижней границы, до верхней"""
+        for tense_type, pool in self.pools.items():
+            if len(pool) >= self.low_watermark:
+                continue
+            
+            while len(pool) < self.high_watermark:
+                # Не конкурируем с пользователями за Gemini
+                if not GeminiService.is_idle():
+                    return
+                
+                success, result = await GrammarTest().generate_questions(tense_type, priority='pool')
+                if not success:
+                    self.stats['failed'] += 1
+                    logger.warning("Не удалось пополнить пул тестов (%s): %s", tense_type, result[:100])
+                    return
+                
+                await self.put_test(tense_type, result)
+                self.stats['generated'] += 1
+    
+    async def run(self):
+        """Фоновый цикл пополнения пула"""
+        while True:
+            try:
+                await self.refill_once()
+            except Exception:
+                logger.exception("Ошибка при пополнении пула тестов")
+            
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def start(self):
+        """Загрузить пул и запустить фоновое пополнение (внутри работающего event loop)"""
+        if self.refill_task is None:
+            await self.load()
+            self.refill_task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        """Остановить фоновое пополнение"""
+        if self.refill_task is not None:
+            self.refill_task.cancel()
+            try:
+                await self.refill_task
+            except asyncio.CancelledError:
+                pass
+            self.refill_task = None
@@ -0,0 +1,63 @@
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HealthServer:
+    """Минимальный HTTP-сервер с проверкой работоспособности (GET /health).
+    
+    Встроенный веб-сервер python-telegram-bot принимает только обновления
+    Telegram, поэтому проверка для балансировщика работает на отдельном порту.
+    """
+    
+    def __init__(self, listen, port, get_status=None):
+        self.listen = listen
+        self.port = port
+        self.get_status = get_status  # функция, возвращающая словарь с подробностями
+        self.server = None
+    
+    async def handle(self, reader, writer):
+        """Ответить на один HTTP-запрос"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Пропускаем заголовки до пустой строки
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] in ('GET', 'HEAD') and parts[1].split('?')[0] == '/health':
+                body = {'status': 'ok'}
+                if self.get_status:
+                    body.update(self.get_status())
+                status = '200 OK'
+            else:
+                body = {'error': 'not found'}
+                status = '404 Not Found'
+            
+            payload = json.dumps(body).encode()
+            head = (
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+            writer.write(head if parts[:1] == ['HEAD'] else head + payload)
+            await writer.drain()
+        except Exception:
+            logger.debug("Ошибка обработки запроса проверки работоспособности", exc_info=True)
+        finally:
+            writer.close()
+    
+    async def start(self):
+        """Начать принимать запросы"""
+        self.server = await asyncio.start_server(self.handle, self.listen, self.port)
+        logger.info("Проверка работоспособности: http://%s:%s/health", self.listen, self.port)
+    
+    async def stop(self):
+        """Остановить сервер"""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
@@ -0,0 +1,49 @@
+class ParseStats:
+    """Счётчики разбора ответов Gemini по функциям (test, vocabulary, grammar) и режимам (json, text).
+    
+    ok - ответ разобран основным парсером режима, fallback - помог запасной
+    текстовый парсер, failed - разобрать не удалось и нужна повторная генерация.
+    """
+    
+    OUTCOMES = ('ok', 'fallback', 'failed')
+    
+    def __init__(self):
+        self.counters = {}  # (feature, mode) -> {outcome: count}
+        self.repairs = {}  # feature -> {'requests', 'requested', 'recovered'}
+    
+    def record(self, feature, mode, outcome):
+        counters = self.counters.setdefault((feature, mode), dict.fromkeys(self.OUTCOMES, 0))
+        counters[outcome] += 1
+    
+    def record_repair(self, feature, requested, recovered):
+        """Учесть догенерацию недостающих элементов: сколько просили и сколько получили"""
+        repairs = self.repairs.setdefault(feature, {'requests': 0, 'requested': 0, 'recovered': 0})
+        repairs['requests'] += 1
+        repairs['requested'] += requested
+        repairs['recovered'] += recovered
+    
+    def get_repair_stats(self):
+        """Получить статистику догенерации по функциям"""
+        return {
+            feature: dict(repairs, recovery_rate=round(repairs['recovered'] / repairs['requested'], 2))
+            for feature, repairs in self.repairs.items()
+            if repairs['requested']
+        }
+    
+    def get_stats(self):
+        """Получить доли неудачного разбора и повторной генерации"""
+        stats = {}
+        for (feature, mode), counters in sorted(self.counters.items()):
+            total = sum(counters.values())
+            stats[f"{feature}/{mode}"] = {
+                'total': total,
+                'fallback': counters['fallback'],
+                'failed': counters['failed'],
+                'parse_failure_rate': round((counters['fallback'] + counters['failed']) / total, 2),
+                'regeneration_rate': round(counters['failed'] / total, 2)
+            }
+        return stats
+
+
+# Общие счётчики для всего бота
+parse_stats = ParseStats()
@@ -0,0 +1,146 @@
+import asyncio
+import time
+from collections import deque
+
+
+class QueueFullError(Exception):
+    """Очередь запросов данного класса переполнена - запрос отброшен"""
+
+
+class TokenBucket:
+    """Корзина токенов: не больше capacity единиц, пополняется на capacity за минуту"""
+    
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def wait_time(self, amount):
+        """Сколько секунд ждать, пока в корзине наберётся amount единиц"""
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+    
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+    
+    def give_back(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RequestScheduler:
+    """Общий планировщик запросов к Gemini с приоритетами.
+    
+    Запрос получает разрешение, только когда он первый в самом приоритетном
+    непустом классе, есть свободный слот (max_concurrent) и хватает токенов
+    в корзинах запросов (RPM) и токенов модели (TPM). Поэтому фоновое
+    пополнение пула не может занять квоту, нужную реплике в диалоге.
+    Очередь каждого класса ограничена: при переполнении новый запрос отбрасывается.
+    """
+    
+    # Классы в порядке убывания приоритета
+    PRIORITIES = ('dialogue', 'grammar', 'vocabulary', 'test', 'pool')
+    
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrent, max_queue):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queues = {name: deque() for name in self.PRIORITIES}  # (future, tokens, enqueued_at)
+        self.active = 0
+        self.timer = None
+        self.stats = {
+            name: {'granted': 0, 'shed': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for name in self.PRIORITIES
+        }
+    
+    def is_idle(self):
+        """Нет ни выполняющихся, ни ожидающих запросов"""
+        return self.active == 0 and not any(self.queues.values())
+    
+    async def acquire(self, priority, tokens):
+        """Дождаться разрешения на запрос; tokens - оценка расхода токенов модели"""
+        queue = self.queues[priority]
+        if len(queue) >= self.max_queue:
+            self.stats[priority]['shed'] += 1
+            raise QueueFullError(f"Очередь запросов '{priority}' переполнена")
+        
+        waiter = (asyncio.get_running_loop().create_future(), tokens, time.monotonic())
+        queue.append(waiter)
+        self.dispatch()
+        
+        try:
+            await waiter[0]
+        except asyncio.CancelledError:
+            if waiter[0].done() and not waiter[0].cancelled():
+                # Разрешение уже выдано, но вызывающий ушёл (например, по таймауту)
+                self.release(tokens, 0)
+            else:
+                if waiter in queue:
+                    queue.remove(waiter)
+                self.dispatch()
+            raise
+    
+    def release(self, reserved_tokens, used_tokens):
+        """Освободить слот и вернуть в корзину неизрасходованные токены"""
+        self.active -= 1
+        if used_tokens < reserved_tokens:
+            self.tokens.give_back(reserved_tokens - used_tokens)
+        self.dispatch()
+    
+    def dispatch(self):
+        """Выдать разрешения ожидающим запросам, пока позволяют слоты и корзины"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        
+        while self.active < self.max_concurrent:
+            priority = next((name for name in self.PRIORITIES if self.queues[name]), None)
+            if priority is None:
+                return
+            
+            future, tokens, enqueued_at = self.queues[priority][0]
+            if future.cancelled():
+                self.queues[priority].popleft()
+                continue
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait > 0:
+                # Более низкие классы не обгоняют ждущий запрос: проверим снова, когда корзины пополнятся
+                self.timer = asyncio.get_running_loop().call_later(wait, self.dispatch)
+                return
+            
+            self.queues[priority].popleft()
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.active += 1
+            
+            waited = time.monotonic() - enqueued_at
+            stats = self.stats[priority]
+            stats['granted'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+            future.set_result(None)
+    
+    def get_stats(self):
+        """Получить глубину очередей и время ожидания по классам"""
+        return {
+            'active': self.active,
+            'classes': {
+                name: {
+                    'queued': len(self.queues[name]),
+                    'granted': stats['granted'],
+                    'shed': stats['shed'],
+                    'avg_wait': round(stats['wait_total'] / stats['granted'], 2) if stats['granted'] else 0.0,
+                    'max_wait': round(stats['wait_max'], 2)
+                }
+                for name, stats in self.stats.items()
+            }
+        }
@@ -0,0 +1,88 @@
+import time
+from collections import deque
+
+
+class CircuitBreaker:
+    """Автоматический выключатель для внешнего сервиса.
+    
+    После failure_threshold ошибок подряд размыкается: запросы сразу
+    отклоняются в течение reset_timeout секунд. Затем пропускается один
+    пробный запрос - при успехе выключатель замыкается, при ошибке снова
+    размыкается.
+    """
+    
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'  # closed, open или half_open
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = None
+        self.stats = {'opened': 0, 'rejected': 0}
+    
+    def allow_request(self):
+        """Можно ли сейчас обращаться к сервису"""
+        now = time.monotonic()
+        if self.state == 'open':
+            if now - self.opened_at < self.reset_timeout:
+                self.stats['rejected'] += 1
+                return False
+            self.state = 'half_open'
+            self.probe_started_at = None
+        
+        if self.state == 'half_open':
+            # Один пробный запрос; если он пропал (отменён), через reset_timeout пускаем следующий
+            if self.probe_started_at is not None and now - self.probe_started_at < self.reset_timeout:
+                self.stats['rejected'] += 1
+                return False
+            self.probe_started_at = now
+        return True
+    
+    def is_open(self):
+        """Разомкнут ли выключатель (после reset_timeout он готов пропустить пробный запрос)"""
+        return self.state == 'open' and time.monotonic() - self.opened_at < self.reset_timeout
+    
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.probe_started_at = None
+    
+    def release_probe(self):
+        """Запрос завершился без ответа сервиса (локальная ошибка): состояние не меняется,
+        но если запрос был пробным, следующий может сразу стать новой пробой"""
+        self.probe_started_at = None
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                self.stats['opened'] += 1
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.probe_started_at = None
+    
+    def get_stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opened': self.stats['opened'],
+            'rejected': self.stats['rejected']
+        }
+
+
+class LatencyTracker:
+    """Скользящее окно последних задержек для оценки перцентилей"""
+    
+    def __init__(self, window=200, min_samples=20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+    
+    def record(self, seconds):
+        self.samples.append(seconds)
+    
+    def percentile(self, p):
+        """Перцентиль p (0-100) или None, пока данных недостаточно"""
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
@@ -0,0 +1,118 @@
+from database import AsyncDatabase
+from session_store import session_store
+from config import REVIEW_SESSION_SIZE
+
+
+class Review:
+    """Интервальное повторение изученных слов (алгоритм SM-2).
+    
+    Ответы оцениваются локально, без обращения к Gemini. Новые интервалы
+    считаются в SQL (Database.REVIEW_USER_WORD) и применяются пачками.
+    """
+    
+    # Оценки ответа по шкале SM-2
+    GRADES = {
+        0: "😣 Не помню",
+        3: "🤔 С трудом",
+        4: "🙂 Помню",
+        5: "😎 Легко"
+    }
+    
+    def __init__(self):
+        self.db = AsyncDatabase()
+        # Текущие сессии повторения для каждого пользователя
+        self.sessions = session_store.namespace(
+            'review',
+            dump=self.session_to_state,
+            load=self.session_from_state
+        )
+    
+    # Поля карточки, которые хранятся в сессии
+    CARD_FIELDS = ('word_id', 'word', 'transcription', 'translation', 'example_en', 'example_ru', 'due_at')
+    
+    @classmethod
+    def session_to_state(cls, session):
+        """Сессия повторения в JSON-совместимом виде (для общего хранилища состояний)"""
+        return {
+            'cards': [{field: card.get(field) for field in cls.CARD_FIELDS} for card in session['cards']],
+            'index': session['index'],
+            'remembered': session['remembered']
+        }
+    
+    @classmethod
+    def session_from_state(cls, state):
+        """Восстановить сессию из состояния, полученного через session_to_state"""
+        return {
+            'cards': [{field: card.get(field) for field in cls.CARD_FIELDS} for card in state['cards']],
+            'index': int(state['index']),
+            'remembered': int(state['remembered'])
+        }
+    
+    async def start_review(self, user_id):
+        """Начать повторение: загрузить карточки, которые пора повторить"""
+        cards = await self.db.get_due_words(user_id, REVIEW_SESSION_SIZE)
+        if not cards:
+            self.sessions.pop(user_id, None)
+            return False
+        
+        self.sessions[user_id] = {
+            'cards': cards,
+            'index': 0,
+            'remembered': 0
+        }
+        return True
+    
+    def get_current_card(self, user_id):
+        """Получить текущую карточку"""
+        session = self.sessions.get(user_id)
+        if not session or session['index'] >= len(session['cards']):
+            return None
+        
+        card = session['cards'][session['index']]
+        return dict(card, number=session['index'] + 1, total=len(session['cards']))
+    
+    async def grade_card(self, user_id, grade):
+        """Оценить ответ на текущую карточку и перейти к следующей"""
+        card = self.get_current_card(user_id)
+        if card is None or grade not in self.GRADES:
+            return False
+        
+        session = self.sessions[user_id]
+        await self.db.save_review(user_id, card['word_id'], grade)
+        if grade >= 3:
+            session['remembered'] += 1
+        session['index'] += 1
+        return True
+    
+    def finish_review(self, user_id):
+        """Завершить сессию и вернуть статистику"""
+        session = self.sessions.pop(user_id, None)
+        if not session:
+            return None
+        return {
+            'reviewed': session['index'],
+            'remembered': session['remembered']
+        }
+    
+    async def get_next_due_at(self, user_id):
+        """Когда будет следующее повторение"""
+        return await self.db.get_next_due_at(user_id)
+    
+    def format_card_front(self, card):
+        """Лицевая сторона карточки: слово без перевода"""
+        text = f"🔁 Повторение {card['number']}/{card['total']}\n\n"
+        text += f"*{card['word']}* {card['transcription']}\n\n"
+        text += "Вспомните перевод и нажмите кнопку."
+        return text
+    
+    def format_card_back(self, card):
+        """Обратная сторона карточки: перевод и примеры"""
+        text = f"🔁 Повторение {card['number']}/{card['total']}\n\n"
+        text += f"*{card['word']}* {card['transcription']}\n"
+        text += f"_{card['translation']}_\n"
+        if card.get('example_en'):
+            text += f"🇬🇧 {card['example_en']}\n"
+        if card.get('example_ru'):
+            text += f"🇷🇺 {card['example_ru']}\n"
+        text += "\nНасколько хорошо вы помнили?"
+        return text
@@ -0,0 +1,439 @@
+import asyncio
+import inspect
+import json
+import logging
+import sys
+import time
+import uuid
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from config import (
+    SESSION_BACKEND,
+    SESSION_MAX_ENTRIES,
+    SESSION_TTL,
+    SESSION_SWEEP_INTERVAL,
+    SESSION_LEASE_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_size(value, seen=None, depth=0):
+    """Приблизительный размер состояния в байтах.
+    
+    Контейнеры обходятся рекурсивно; у объектов учитываются атрибуты только
+    самого верхнего уровня (вложенные сервисы вроде GeminiService общие и не считаются).
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k, seen, depth + 1) + estimate_size(v, seen, depth + 1) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, deque)):
+        size += sum(estimate_size(item, seen, depth + 1) for item in value)
+    elif depth == 0 and hasattr(value, '__dict__'):
+        size += estimate_size(vars(value), seen, depth + 1)
+    return size
+
+
+class SQLiteSessionBackend:
+    """Общее хранилище состояний в SQLite (таблица sessions).
+    
+    Позволяет нескольким процессам бота работать с одной базой: на время
+    обработки обновления процесс берёт аренду пользователя (таблица
+    session_leases), поэтому обновления одного пользователя разные процессы
+    обрабатывают по очереди. Состояние читается после получения аренды и
+    записывается перед её возвратом; номер версии записи (оптимистичная
+    блокировка) остаётся защитой на случай, если аренда истекла.
+    """
+    
+    # Пауза между попытками взять занятую аренду (секунды): начальная и наибольшая
+    LEASE_RETRY_DELAY = 0.05
+    LEASE_RETRY_MAX_DELAY = 1.0
+    
+    def __init__(self, db=None, lease_timeout=SESSION_LEASE_TIMEOUT):
+        if db is None:
+            from database import AsyncDatabase
+            db = AsyncDatabase()
+        self.db = db
+        self.lease_timeout = lease_timeout
+        self.owner = uuid.uuid4().hex  # этот процесс
+    
+    async def acquire(self, user_id):
+        """Дождаться аренды пользователя (другой процесс обрабатывает его обновление)"""
+        delay = self.LEASE_RETRY_DELAY
+        while True:
+            now = time.time()
+            if await self.db.acquire_session_lease(user_id, self.owner, now, now + self.lease_timeout):
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.LEASE_RETRY_MAX_DELAY)
+    
+    async def release(self, user_id):
+        """Вернуть аренду пользователя"""
+        await self.db.release_session_lease(user_id, self.owner)
+    
+    async def load_user(self, user_id):
+        """Получить {namespace: (json, version)} пользователя"""
+        return await self.db.get_user_sessions(user_id)
+    
+    async def save_user(self, user_id, writes, deletes, touches):
+        """Записать изменения пользователя, вернуть namespace с конфликтом версий"""
+        return await self.db.save_user_sessions(user_id, writes, deletes, touches, time.time())
+    
+    async def take_expired(self, namespace, ttl):
+        """Забрать истёкшие состояния [(user_id, json)]"""
+        return await self.db.take_expired_sessions(namespace, time.time() - ttl)
+    
+    async def get_stats(self):
+        """Получить {namespace: {'entries', 'bytes'}}"""
+        return await self.db.get_session_stats()
+
+
+def create_backend(name=SESSION_BACKEND):
+    """Создать хранилище состояний по имени из конфигурации (memory - только память процесса)"""
+    if name == 'memory':
+        return None
+    if name == 'sqlite':
+        return SQLiteSessionBackend()
+    raise ValueError(f"Неизвестное хранилище состояний: {name}")
+
+
+class SessionNamespace:
+    """Словарь состояний пользователей одного вида (тесты, диалоги и т.д.) внутри SessionStore.
+    
+    Поддерживает обычные операции словаря: in, [], del, get, pop.
+    Обращение к записи продлевает её время жизни. dump и load переводят
+    значение в JSON-совместимый вид и обратно для общего хранилища.
+    """
+    
+    def __init__(self, store, name, ttl, on_evict=None, dump=None, load=None):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        self.on_evict = on_evict  # функция или корутина (user_id, value), вызывается при вытеснении
+        self.dump = dump or (lambda value: value)
+        self.load = load or (lambda data: data)
+    
+    def __contains__(self, user_id):
+        return self.store.get_entry(self.name, user_id) is not None
+    
+    def __getitem__(self, user_id):
+        entry = self.store.get_entry(self.name, user_id)
+        if entry is None:
+            raise KeyError(user_id)
+        return entry['value']
+    
+    def __setitem__(self, user_id, value):
+        self.store.set_entry(self.name, user_id, value)
+    
+    def __delitem__(self, user_id):
+        if not self.store.remove_entry(self.name, user_id):
+            raise KeyError(user_id)
+    
+    def get(self, user_id, default=None):
+        entry = self.store.get_entry(self.name, user_id)
+        return entry['value'] if entry is not None else default
+    
+    def pop(self, user_id, default=None):
+        entry = self.store.get_entry(self.name, user_id)
+        if entry is None:
+            return default
+        self.store.remove_entry(self.name, user_id)
+        return entry['value']
+
+
+class ConversationStates(MutableMapping):
+    """Состояния ConversationHandler, хранящиеся в пространстве имён SessionStore.
+    
+    ConversationHandler обращается к ним как к словарю с ключом (chat_id, user_id);
+    состояния пользователя лежат в одной записи {chat_id: состояние}, поэтому
+    загружаются и сохраняются вместе с остальными его состояниями. Итерация и
+    длина охватывают только записи, загруженные в память этого процесса.
+    """
+    
+    def __init__(self, store, name):
+        self.namespace = store.namespace(name, dump=self.dump, load=self.load)
+    
+    @staticmethod
+    def dump(states):
+        return {str(chat_id): state for chat_id, state in states.items()}
+    
+    @staticmethod
+    def load(data):
+        return {int(chat_id): int(state) for chat_id, state in data.items()}
+    
+    def __getitem__(self, key):
+        chat_id, user_id = key
+        return self.namespace.get(user_id, {})[chat_id]
+    
+    def __setitem__(self, key, state):
+        chat_id, user_id = key
+        # Новый словарь, чтобы save_user заметил изменение
+        self.namespace[user_id] = {**self.namespace.get(user_id, {}), chat_id: state}
+    
+    def __delitem__(self, key):
+        chat_id, user_id = key
+        states = dict(self.namespace.get(user_id, {}))
+        del states[chat_id]
+        if states:
+            self.namespace[user_id] = states
+        else:
+            del self.namespace[user_id]
+    
+    def __iter__(self):
+        store = self.namespace.store
+        keys = [key for key in store.entries if key[0] == self.namespace.name]
+        for _, user_id in keys:
+            for chat_id in store.entries[(self.namespace.name, user_id)]['value']:
+                yield chat_id, user_id
+    
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class SessionStore:
+    """Ограниченное хранилище состояний пользователей в памяти.
+    
+    У каждой записи есть время жизни (TTL с момента последнего обращения),
+    общее число записей ограничено - при переполнении вытесняются давно не
+    использованные (LRU). При вытеснении вызывается обработчик пространства
+    имён, который может сохранить незавершённый тест или диалог.
+    
+    Если задано общее хранилище (backend), память служит лишь рабочей копией
+    на время обработки одного обновления: load_user загружает состояния
+    пользователя, save_user записывает изменённые и удаляет их из памяти.
+    Изменения, сделанные фоновыми задачами после save_user, в общее хранилище
+    не попадают, поэтому с backend такие задачи не должны менять состояния
+    (например, тест не догенерируется в фоне).
+    """
+    
+    def __init__(self, backend=None, max_entries=SESSION_MAX_ENTRIES, sweep_interval=SESSION_SWEEP_INTERVAL):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self.entries = OrderedDict()  # (namespace, user_id) -> {'value', 'touched_at', 'version', 'dumped'}
+        self.removed = {}  # (namespace, user_id) -> версия удалённой записи общего хранилища
+        self.namespaces = {}
+        self.sweep_task = None
+        self.hook_tasks = set()
+        self.stats = {'expired': 0, 'evicted': 0, 'conflicts': 0}
+    
+    def namespace(self, name, ttl=SESSION_TTL, on_evict=None, dump=None, load=None):
+        """Получить (создать) пространство имён для состояний одного вида"""
+        if name not in self.namespaces:
+            self.namespaces[name] = SessionNamespace(self, name, ttl, on_evict, dump, load)
+        return self.namespaces[name]
+    
+    def get_entry(self, name, user_id):
+        """Получить запись (продлевая её жизнь) или None, если её нет или она истекла"""
+        key = (name, user_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        
+        now = time.monotonic()
+        if now - entry['touched_at'] > self.namespaces[name].ttl:
+            self.stats['expired'] += 1
+            self.evict(key)
+            return None
+        
+        entry['touched_at'] = now
+        self.entries.move_to_end(key)
+        return entry
+    
+    def set_entry(self, name, user_id, value):
+        """Сохранить запись, вытеснив самые старые при переполнении"""
+        key = (name, user_id)
+        previous = self.entries.get(key)
+        self.entries[key] = {
+            'value': value,
+            'touched_at': time.monotonic(),
+            # Новое значение заменяет ту же запись общего хранилища
+            'version': previous['version'] if previous else self.removed.pop(key, None),
+            'dumped': None
+        }
+        self.entries.move_to_end(key)
+        
+        while len(self.entries) > self.max_entries:
+            self.stats['evicted'] += 1
+            self.evict(next(iter(self.entries)))
+    
+    def remove_entry(self, name, user_id):
+        """Удалить запись без вызова обработчика (обычное завершение)"""
+        return self.pop_entry((name, user_id)) is not None
+    
+    def pop_entry(self, key):
+        """Убрать запись из памяти, запомнив её версию для удаления из общего хранилища"""
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry['version'] is not None:
+            self.removed[key] = entry['version']
+        return entry
+    
+    def evict(self, key):
+        """Вытеснить запись и вызвать обработчик пространства имён"""
+        entry = self.pop_entry(key)
+        if entry is None:
+            return
+        self.run_evict_hook(key, entry['value'])
+    
+    def run_evict_hook(self, key, value):
+        """Вызвать обработчик вытеснения пространства имён"""
+        
+        name, user_id = key
+        on_evict = self.namespaces[name].on_evict
+        if on_evict is None:
+            return
+        
+        try:
+            result = on_evict(user_id, value)
+            if inspect.isawaitable(result):
+                task = asyncio.ensure_future(result)
+                self.hook_tasks.add(task)
+                task.add_done_callback(self.hook_tasks.discard)
+        except Exception:
+            logger.exception("Ошибка при сохранении вытесненного состояния %s", key)
+    
+    async def load_user(self, user_id):
+        """Загрузить состояния пользователя из общего хранилища перед обработкой обновления"""
+        if self.backend is None:
+            return
+        
+        await self.backend.acquire(user_id)
+        try:
+            rows = await self.backend.load_user(user_id)
+        except BaseException:
+            await self.backend.release(user_id)
+            raise
+        now = time.monotonic()
+        for name, (data, version) in rows.items():
+            namespace = self.namespaces.get(name)
+            if namespace is None:
+                continue
+            try:
+                value = namespace.load(json.loads(data))
+            except Exception:
+                logger.exception("Не удалось восстановить состояние %s пользователя %s", name, user_id)
+                self.removed[(name, user_id)] = version
+                continue
+            self.entries[(name, user_id)] = {
+                'value': value,
+                'touched_at': now,
+                'version': version,
+                'dumped': data
+            }
+    
+    async def save_user(self, user_id):
+        """Записать изменённые состояния пользователя в общее хранилище, убрать их из памяти
+        и вернуть аренду пользователя.
+        
+        Конфликт версий возможен, только если обработка длилась дольше аренды и
+        запись успел изменить другой процесс: его версия сохраняется, а наши
+        изменения отбрасываются (конфликт учитывается в статистике).
+        """
+        if self.backend is None:
+            return
+        
+        try:
+            await self.write_user(user_id)
+        finally:
+            await self.backend.release(user_id)
+    
+    async def write_user(self, user_id):
+        """Записать изменённые состояния пользователя в общее хранилище"""
+        writes, deletes, touches = [], [], []
+        for name, namespace in self.namespaces.items():
+            key = (name, user_id)
+            entry = self.entries.pop(key, None)
+            removed_version = self.removed.pop(key, None)
+            if entry is None:
+                if removed_version is not None:
+                    deletes.append((name, removed_version))
+                continue
+            
+            data = json.dumps(namespace.dump(entry['value']), ensure_ascii=False, default=str)
+            if data == entry['dumped']:
+                touches.append(name)
+            else:
+                writes.append((name, data, entry['version']))
+        
+        if not (writes or deletes or touches):
+            return
+        
+        conflicts = await self.backend.save_user(user_id, writes, deletes, touches)
+        for name in conflicts:
+            self.stats['conflicts'] += 1
+            logger.warning("Конфликт версий состояния %s пользователя %s, изменения отброшены", name, user_id)
+    
+    async def purge_expired(self):
+        """Удалить все истёкшие записи"""
+        if self.backend is not None:
+            for name, namespace in self.namespaces.items():
+                for user_id, data in await self.backend.take_expired(name, namespace.ttl):
+                    self.stats['expired'] += 1
+                    if namespace.on_evict is not None:
+                        self.run_evict_hook((name, user_id), namespace.load(json.loads(data)))
+            return
+        
+        now = time.monotonic()
+        expired = [
+            key for key, entry in self.entries.items()
+            if now - entry['touched_at'] > self.namespaces[key[0]].ttl
+        ]
+        for key in expired:
+            self.stats['expired'] += 1
+            self.evict(key)
+    
+    async def get_stats(self):
+        """Получить число записей и занятую память по пространствам имён"""
+        namespaces = {name: {'entries': 0, 'bytes': 0} for name in self.namespaces}
+        if self.backend is not None:
+            namespaces.update(await self.backend.get_stats())
+        else:
+            # Размер считается при каждом запросе: обработчики меняют состояния на месте
+            # (например, дописывают сообщения диалога), и замер при записи быстро устаревает
+            for (name, _), entry in self.entries.items():
+                namespaces[name]['entries'] += 1
+                namespaces[name]['bytes'] += estimate_size(entry['value'])
+        return {
+            'entries': sum(ns['entries'] for ns in namespaces.values()),
+            'bytes': sum(ns['bytes'] for ns in namespaces.values()),
+            'namespaces': namespaces,
+            'expired': self.stats['expired'],
+            'evicted': self.stats['evicted'],
+            'conflicts': self.stats['conflicts']
+        }
+    
+    async def run(self):
+        """Фоновая очистка истёкших записей"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.purge_expired()
+            except Exception:
+                logger.exception("Ошибка очистки истёкших состояний")
+    
+    def start(self):
+        """Запустить фоновую очистку (внутри работающего event loop)"""
+        if self.sweep_task is None:
+            self.sweep_task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        """Остановить очистку и дождаться сохранения вытесненных состояний"""
+        if self.sweep_task is not None:
+            self.sweep_task.cancel()
+            try:
+                await self.sweep_task
+            except asyncio.CancelledError:
+                pass
+            self.sweep_task = None
+        if self.hook_tasks:
+            await asyncio.gather(*self.hook_tasks, return_exceptions=True)
+
+
+# Общее хранилище состояний для всего бота
+session_store = SessionStore(create_backend())
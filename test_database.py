@@ -0,0 +1,67 @@
+import pytest
+
+import database
+from database import Database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """База во временном файле со всеми миграциями"""
+    monkeypatch.setattr(database, 'DATABASE_FILE', str(tmp_path / 'test.db'))
+    db = Database()
+    yield db
+    db.close_connection()
+
+
+def assert_uses_index(plan, index):
+    """План читает таблицу через индекс, без полного просмотра и временной сортировки"""
+    assert any(f'INDEX {index}' in detail for detail in plan), plan
+    assert not any(detail.startswith('SCAN') for detail in plan), plan
+    assert not any('USE TEMP B-TREE' in detail for detail in plan), plan
+
+
+def test_test_history_uses_index(db):
+    plan = db.explain_query_plan(Database.SELECT_TEST_HISTORY, (1,))
+    assert_uses_index(plan, 'idx_grammar_tests_user_completed')
+
+
+def test_user_vocabulary_uses_index(db):
+    plan = db.explain_query_plan(Database.SELECT_USER_VOCABULARY, (1,))
+    assert_uses_index(plan, 'idx_vocabulary_user_summary')
+
+
+def test_unseen_questions_by_tense_uses_index(db):
+    plan = db.explain_query_plan(Database.SELECT_UNSEEN_QUESTIONS_BY_TENSE, ('past', 1, 100, 1, 10))
+    assert_uses_index(plan, 'idx_questions_tense')
+
+
+def test_failed_migration_is_rolled_back(db, monkeypatch):
+    """Сбой посреди миграции не оставляет добавленных столбцов без новой версии"""
+    def fail(cursor):
+        raise RuntimeError("сбой посреди миграции")
+    
+    version = len(Database.MIGRATIONS)
+    migration = ['ALTER TABLE users ADD COLUMN migration_probe TEXT', fail]
+    monkeypatch.setattr(Database, 'MIGRATIONS', Database.MIGRATIONS + [migration])
+    with pytest.raises(RuntimeError):
+        db.apply_migrations()
+    
+    conn = db.get_connection()
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == version
+    assert 'migration_probe' not in [row[1] for row in conn.execute('PRAGMA table_info(users)')]
+    
+    # Повторный запуск применяет миграцию заново, без ошибки "duplicate column"
+    migration[1] = 'SELECT 1'
+    db.apply_migrations()
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == version + 1
+
+
+def test_session_lease_is_exclusive_until_released_or_expired(db):
+    assert db.acquire_session_lease(1, 'first', 100.0, 400.0)
+    assert not db.acquire_session_lease(1, 'second', 200.0, 500.0)
+    
+    db.release_session_lease(1, 'first')
+    assert db.acquire_session_lease(1, 'second', 200.0, 500.0)
+    
+    # Аренда процесса, который не вернул её, истекает
+    assert db.acquire_session_lease(1, 'third', 600.0, 900.0)
@@ -0,0 +1,73 @@
+import pytest
+
+from benchmark_parsers import ADVERSARIAL
+from grammar_test import GrammarTest
+
+
+NUMBERED_RESPONSE = """1. She ___ to school every day.
+a) go
+b) goes
+c) going
+d) gone
+Correct answer: b
+Explanation: Present Simple.
+Третье лицо единственного числа требует окончания -s.
+
+2. They ___ here since 2010.
+a) live
+b) lived
+c) have lived
+d) are living
+Correct answer: c
+Explanation: Present Perfect with since.
+"""
+
+
+FALLBACK_PATTERNS = ('FALLBACK_HEADER', 'FALLBACK_OPTION', 'FALLBACK_ANSWER', 'FALLBACK_DIFFICULTY', 'FALLBACK_EXPLANATION')
+
+
+class CountingPattern:
+    """Обёртка над скомпилированным шаблоном, запоминающая строки, к которым его применяли"""
+    
+    def __init__(self, pattern, calls):
+        self.pattern = pattern
+        self.calls = calls
+    
+    def match(self, string):
+        self.calls.append(string)
+        return self.pattern.match(string)
+
+
+@pytest.mark.parametrize('case', ADVERSARIAL)
+def test_fallback_parse_is_single_pass(case, monkeypatch):
+    """Испорченный вывод разбирается за один проход: каждый шаблон видит строку не больше одного раза"""
+    calls = []
+    for name in FALLBACK_PATTERNS:
+        monkeypatch.setattr(GrammarTest, name, CountingPattern(getattr(GrammarTest, name), calls))
+    response = ADVERSARIAL[case](20000)
+    
+    GrammarTest.fallback_parse(response)
+    
+    lines = response.splitlines()
+    assert len(calls) <= len(FALLBACK_PATTERNS) * len(lines)
+    # Шаблоны применяются к отдельным строкам, а не к остатку ответа
+    assert sum(len(string) for string in calls) <= len(FALLBACK_PATTERNS) * len(response)
+
+
+def test_fallback_parse_keeps_multiline_explanation():
+    questions = GrammarTest.fallback_parse(NUMBERED_RESPONSE)
+    
+    assert [q['correct_answer'] for q in questions] == ['b', 'c']
+    assert questions[0]['explanation'] == (
+        "Present Simple. Третье лицо единственного числа требует окончания -s."
+    )
+    assert questions[1]['explanation'] == "Present Perfect with since."
+
+
+def test_fallback_parse_ends_explanation_at_paragraph():
+    """Абзац после объяснения - текст следующего вопроса, а не продолжение объяснения"""
+    response = NUMBERED_RESPONSE.replace("2. They", "They")
+    questions = GrammarTest.fallback_parse(response)
+    
+    assert questions[0]['explanation'].endswith("окончания -s.")
+    assert questions[1]['question'] == "They ___ here since 2010."
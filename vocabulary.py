@@ -1,13 +1,49 @@
+import json
 import re
 from gemini_service import GeminiService
-from database import Database
+from database import AsyncDatabase, word_lemma
+from cache import PersistentCache
+from session_store import session_store
+from parse_stats import parse_stats
+from config import VOCABULARY_CACHE_SIZE, VOCABULARY_CACHE_PERSISTENT_SIZE, VOCABULARY_CACHE_TTL
 
 
 class Vocabulary:
+    # Меньше слов по теме не показываем (проверяется после догенерации недостающих)
+    MIN_WORDS = 3
+    
     def __init__(self):
         self.gemini = GeminiService()
-        self.db = Database()
-        self.current_words = {}  # Храним текущие слова для каждого пользователя
+        self.db = AsyncDatabase()
+        # Храним текущие слова для каждого пользователя
+        self.current_words = session_store.namespace(
+            'current_words',
+            dump=self.words_to_state,
+            load=self.words_to_state
+        )
+        # Кэш сгенерированных слов по теме (большинство пользователей выбирают одни и те же темы)
+        self.cache = PersistentCache(
+            'vocabulary',
+            VOCABULARY_CACHE_SIZE,
+            VOCABULARY_CACHE_TTL,
+            VOCABULARY_CACHE_PERSISTENT_SIZE
+        )
+    
+    # Поля слова, которые хранятся в состоянии пользователя
+    WORD_FIELDS = ('word', 'transcription', 'translation', 'example_en', 'example_ru')
+    
+    @classmethod
+    def words_to_state(cls, vocabulary_data):
+        """Текущие слова в JSON-совместимом виде (то же преобразование восстанавливает их из состояния)"""
+        return {
+            'topic': vocabulary_data.get('topic', 'Unknown'),
+            'words': [{field: word.get(field, '') for field in cls.WORD_FIELDS} for word in vocabulary_data['words']]
+        }
+    
+    @staticmethod
+    def normalize_topic(topic):
+        """Нормализовать тему для ключа кэша"""
+        return re.sub(r'\s+', ' ', topic.strip().lower())
     
     def parse_vocabulary_response(self, response, topic):
         """Парсить текстовый ответ от Gemini и извлечь слова"""
@@ -26,9 +62,11 @@ class Vocabulary:
             except Exception:
                 continue
         
-        # Если основной метод не сработал, пробуем fallback
-        if len(words) < 3:
-            words = self.fallback_parse(response)
+        # Если основной метод нашёл мало слов, пробуем fallback и берём его, только если он нашёл больше
+        if len(words) < self.MIN_WORDS:
+            fallback_words = self.fallback_parse(response)
+            if len(fallback_words) > len(words):
+                words = fallback_words
         
         if words:
             return {
@@ -142,26 +180,148 @@ class Vocabulary:
         
         return words
     
-    def generate_words(self, topic, number_of_words=10):
-        """Сгенерировать слова по теме"""
-        response = self.gemini.generate_vocabulary(topic, number_of_words)
+    async def generate_words(self, topic, number_of_words=10, user_id=None):
+        """Получить слова по теме (из кэша или сгенерировать).
+        
+        Если указан user_id, слова, которые пользователь уже изучил, исключаются.
+        """
+        cache_key = f"{self.normalize_topic(topic)}|{number_of_words}"
+        success, vocabulary_data = await self.cache.get_or_load(
+            cache_key,
+            lambda: self.generate_words_uncached(topic, number_of_words)
+        )
+        
+        if not success:
+            return success, vocabulary_data
+        
+        words = vocabulary_data['words']
+        if user_id is not None:
+            words = await self.exclude_learned_words(user_id, topic, words, number_of_words)
+            if not words:
+                return False, "Все слова по этой теме вы уже изучили. Попробуйте другую тему."
+        
+        # Тему показываем так, как её ввёл этот пользователь
+        return True, dict(vocabulary_data, topic=topic, words=words)
+    
+    async def exclude_learned_words(self, user_id, topic, words, number_of_words):
+        """Убрать уже изученные пользователем слова; если новых мало - догенерировать"""
+        learned = await self.db.get_learned_lemmas(user_id, [word_lemma(w['word']) for w in words])
+        fresh = [w for w in words if word_lemma(w['word']) not in learned]
+        
+        if len(fresh) >= number_of_words // 2:
+            return fresh
+        
+        # Просим Gemini подобрать другие слова, передав уже изученные
+        exclude = [w['word'] for w in words if word_lemma(w['word']) in learned]
+        success, extra_data = await self.generate_words_uncached(topic, number_of_words, exclude)
+        if not success:
+            return fresh
+        
+        extra = extra_data['words']
+        extra_learned = await self.db.get_learned_lemmas(user_id, [word_lemma(w['word']) for w in extra])
+        seen = {word_lemma(w['word']) for w in fresh} | extra_learned
+        for word in extra:
+            lemma = word_lemma(word['word'])
+            if lemma not in seen and len(fresh) < number_of_words:
+                fresh.append(word)
+                seen.add(lemma)
+        
+        return fresh
+    
+    async def generate_words_uncached(self, topic, number_of_words=10, exclude_words=None):
+        """Сгенерировать слова по теме через Gemini"""
+        response = await self.gemini.generate_vocabulary(topic, number_of_words, exclude_words)
         
         # Проверяем на ошибку API
         if response.startswith("GEMINI_ERROR:"):
             return False, response.replace("GEMINI_ERROR: ", "")
         
-        # Парсим текстовый ответ
-        vocabulary_data = self.parse_vocabulary_response(response, topic)
+        mode = 'json' if self.gemini.structured_output else 'text'
+        words, outcome = self.parse_generated_words(response, topic)
+        
+        # Часть слов не распозналась - догенерируем только недостающие
+        if words and len(words) < number_of_words:
+            words = words + await self.fetch_missing_words(topic, words, number_of_words - len(words), exclude_words)
         
-        if vocabulary_data and vocabulary_data.get('words'):
-            return True, vocabulary_data
-        else:
+        # Минимум проверяем по итоговому списку, уже после догенерации
+        if len(words) < min(self.MIN_WORDS, number_of_words):
+            parse_stats.record('vocabulary', mode, 'failed')
             return False, f"Не удалось распознать слова. Попробуйте ещё раз. Ответ: {response[:300]}..."
+        
+        parse_stats.record('vocabulary', mode, outcome)
+        return True, {"topic": topic, "words": words}
     
-    def save_words(self, user_id, vocabulary_data):
+    def parse_generated_words(self, response, topic):
+        """Разобрать ответ Gemini со словами: вернуть (слова, ok или fallback)"""
+        words = []
+        if self.gemini.structured_output:
+            words = self.decode_words_json(response) or []
+            if len(words) >= self.MIN_WORDS:
+                return words, 'ok'
+        
+        # Парсим текстовый ответ (в режиме JSON - запасной вариант, если модель ответила не по схеме);
+        # его результат берём, только если он нашёл больше слов
+        vocabulary_data = self.parse_vocabulary_response(response, topic)
+        text_words = vocabulary_data['words'] if vocabulary_data else []
+        if len(text_words) > len(words):
+            return text_words, 'fallback' if self.gemini.structured_output else 'ok'
+        return words, 'ok'
+    
+    async def fetch_missing_words(self, topic, words, missing, exclude_words=None):
+        """Попросить у Gemini только недостающие слова, передав уже полученные, чтобы не было повторов"""
+        exclude = list(exclude_words or []) + [w['word'] for w in words]
+        response = await self.gemini.generate_vocabulary(topic, missing, exclude)
+        if response.startswith("GEMINI_ERROR:"):
+            parse_stats.record_repair('vocabulary', missing, 0)
+            return []
+        
+        extra, _ = self.parse_generated_words(response, topic)
+        seen = {word_lemma(w['word']) for w in words}
+        added = []
+        for word in extra:
+            lemma = word_lemma(word['word'])
+            if lemma not in seen and len(added) < missing:
+                added.append(word)
+                seen.add(lemma)
+        
+        parse_stats.record_repair('vocabulary', missing, len(added))
+        return added
+    
+    def decode_words_json(self, response):
+        """Разобрать JSON-ответ по VOCABULARY_SCHEMA, отбросив слова без слова или перевода"""
+        try:
+            items = json.loads(response)['words']
+        except (ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(items, list):
+            return None
+        
+        words = []
+        for item in items:
+            try:
+                word = item['word'].strip()
+                translation = item['translation'].strip()
+                transcription = item.get('transcription', '').strip()
+                example_en = item.get('example_en', '').strip()
+                example_ru = item.get('example_ru', '').strip()
+            except (KeyError, TypeError, AttributeError):
+                continue
+            
+            if word and translation:
+                words.append({
+                    "word": word,
+                    "transcription": transcription if transcription else "[-]",
+                    "translation": translation,
+                    "example_en": example_en if example_en else f"Example with {word}.",
+                    "example_ru": example_ru
+                })
+        
+        return words
+    
+    async def save_words(self, user_id, vocabulary_data):
         """Сохранить слова в БД"""
         if 'words' in vocabulary_data:
-            self.db.save_vocabulary(
+            await self.db.save_vocabulary(
                 user_id,
                 vocabulary_data.get('topic', 'Unknown'),
                 vocabulary_data['words']
@@ -216,6 +376,24 @@ class Vocabulary:
         
         return text
     
-    def get_user_vocabulary_history(self, user_id):
+    async def get_vocabulary_page(self, user_id, limit, before=None):
+        """Получить страницу изученных тем (без разбора списков слов).
+        
+        Возвращает (темы, курсор следующей страницы или None).
+        """
+        topics = await self.db.get_user_vocabulary_summary(user_id, limit + 1, before)
+        
+        next_cursor = None
+        if len(topics) > limit:
+            topics = topics[:limit]
+            next_cursor = (topics[-1]['learned_at'], topics[-1]['id'])
+        
+        return topics, next_cursor
+    
+    async def search_words(self, user_id, text, limit=10):
+        """Найти изученные слова по слову, переводу или примеру"""
+        return await self.db.search_user_words(user_id, text, limit)
+    
+    async def get_user_vocabulary_history(self, user_id):
         """Получить историю изученных слов пользователя"""
-        return self.db.get_user_vocabulary(user_id)
\ No newline at end of file
+        return await self.db.get_user_vocabulary(user_id)
\ No newline at end of file
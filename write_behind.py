@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """Очередь отложенной записи: копит вставки и выполняет их пачками.
+    
+    Накопленные строки записываются одной транзакцией (executemany) раз в
+    flush_interval секунд или сразу при накоплении max_batch строк. Если в
+    очереди max_pending записей, новые put ждут освобождения места.
+    Группа put_many - одна запись: её строки всегда попадают в одну транзакцию.
+    """
+    
+    def __init__(self, database, flush_interval, max_batch, max_pending):
+        self.database = database  # AsyncDatabase
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.pending = []  # ([(sql, params), ...], future) - строки одной записи и её future
+        self.pending_rows = 0
+        self.writing = set()  # future записей, которые сейчас пишутся
+        self.slots = None
+        self.wakeup = None
+        self.flush_task = None
+        self.stopping = False
+        self.stats = {'flushes': 0, 'rows': 0, 'failed_rows': 0, 'backpressure_waits': 0}
+    
+    def start(self):
+        """Запустить фоновую запись (создаётся лениво при первой вставке)"""
+        if self.flush_task is None:
+            self.slots = asyncio.Semaphore(self.max_pending)
+            self.wakeup = asyncio.Event()
+            self.flush_task = asyncio.create_task(self.run())
+    
+    async def put(self, sql, params, durable=False):
+        """Поставить вставку в очередь.
+        
+        С durable=True ждёт коммита строки (ошибка записи пробрасывается вызывающему).
+        """
+        await self.put_many([(sql, params)], durable)
+    
+    async def put_many(self, statements, durable=False):
+        """Поставить в очередь несколько вставок (sql, params) одной группой.
+        
+        Группа записывается в одной транзакции: например, тема словаря и её слова.
+        """
+        if not statements:
+            return
+        self.start()
+        
+        # Ограничиваем рост очереди: если места нет, вызывающий ждёт
+        if self.slots.locked():
+            self.stats['backpressure_waits'] += 1
+        await self.slots.acquire()
+        
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((list(statements), future))
+        self.pending_rows += len(statements)
+        if self.pending_rows >= self.max_batch:
+            self.wakeup.set()
+        
+        if durable:
+            await future
+    
+    async def sync(self):
+        """Дождаться записи всего, что уже поставлено в очередь.
+        
+        Вызывается перед чтением, которое должно видеть только что поставленные
+        вставки (например, история сразу после теста). Ошибки записи не пробрасываются.
+        """
+        futures = [future for _, future in self.pending] + list(self.writing)
+        if not futures:
+            return
+        self.wakeup.set()
+        await asyncio.gather(*futures, return_exceptions=True)
+    
+    async def run(self):
+        """Фоновый цикл записи"""
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+    
+    async def flush(self):
+        """Записать всё накопленное, пачками не больше max_batch строк"""
+        while self.pending:
+            # Берём записи целиком, пока не наберётся max_batch строк (хотя бы одну запись)
+            size = rows = 0
+            while size < len(self.pending) and (size == 0 or rows + len(self.pending[size][0]) <= self.max_batch):
+                rows += len(self.pending[size][0])
+                size += 1
+            batch = self.pending[:size]
+            del self.pending[:size]
+            self.pending_rows -= rows
+            self.writing.update(future for _, future in batch)
+            
+            started = time.monotonic()
+            try:
+                await self.write([group for group, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    self.fail(*batch[0], e)
+                else:
+                    # Одна плохая строка или временная блокировка базы не должна терять
+                    # записи других пользователей: пробуем каждую запись отдельно
+                    logger.warning("Не удалось записать пачку из %d строк (%s), записываем группы по одной", rows, e)
+                    for group, future in batch:
+                        try:
+                            await self.write([group])
+                        except Exception as group_error:
+                            self.fail(group, future, group_error)
+                        else:
+                            self.succeed(group, future)
+            else:
+                logger.debug("Записано %d строк за %.3f с", rows, time.monotonic() - started)
+                for group, future in batch:
+                    self.succeed(group, future)
+            finally:
+                for _, future in batch:
+                    self.writing.discard(future)
+                    self.slots.release()
+    
+    async def write(self, groups):
+        """Записать группы одной транзакцией"""
+        # Подряд идущие строки одного запроса выполняем одним executemany.
+        # Порядок вставок сохраняется: следующие запросы могут зависеть от предыдущих
+        statements = []
+        for group in groups:
+            for sql, params in group:
+                if statements and statements[-1][0] == sql:
+                    statements[-1][1].append(params)
+                else:
+                    statements.append((sql, [params]))
+        
+        await self.database.run_write(self.database.database.execute_batch, statements)
+        self.stats['flushes'] += 1
+    
+    def succeed(self, group, future):
+        """Отметить запись группы как выполненную"""
+        self.stats['rows'] += len(group)
+        if not future.done():
+            future.set_result(True)
+    
+    def fail(self, group, future, error):
+        """Отметить запись группы как неудачную"""
+        logger.error("Не удалось записать группу из %d строк: %s", len(group), error)
+        self.stats['failed_rows'] += len(group)
+        if not future.done():
+            future.set_exception(error)
+            # Исключение могут не забрать, если вызывающий не ждал коммита
+            future.exception()
+    
+    async def stop(self):
+        """Остановить фоновую запись, сохранив всё накопленное"""
+        if self.flush_task is not None:
+            self.stopping = True
+            self.wakeup.set()
+            await self.flush_task
+            self.flush_task = None
+        await self.flush()
+    
+    def get_stats(self):
+        """Получить метрики очереди"""
+        return {
+            'pending': self.pending_rows,
+            'flushes': self.stats['flushes'],
+            'rows': self.stats['rows'],
+            'failed_rows': self.stats['failed_rows'],
+            'backpressure_waits': self.stats['backpressure_waits']
+        }